@@ -0,0 +1,71 @@
+"""
+Micro-benchmarks for add_memories: the old list scan against LocationHistory,
+and for embedding and searching the MemoryIndex used by --recall_memories.
+
+    python -m benchmarks.bench_memory_store
+"""
+import time
+from modules.memory_store import LocationHistory
+from modules.memory_index import MemoryIndex
+
+BATCH = [(f"user{i}", f"new message {i}") for i in range(10)]
+
+def fill(size):
+    return [(f"user{i % 50}", f"message number {i}") for i in range(size)]
+
+def list_add_memories(chat_history, context_memory):
+    context_memory = [': '.join(message) for message in context_memory]
+    for memory in reversed(context_memory):
+        if memory not in chat_history:
+            chat_history.append(memory)
+
+def store_add_memories(history, context_memory):
+    for author, content in reversed(context_memory):
+        history.add(author, content)
+
+def timed(function, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start_time) / repeat
+
+def main():
+    for size in (1_000, 100_000, 1_000_000):
+        messages = fill(size)
+
+        chat_history = [': '.join(message) for message in messages]
+        history = LocationHistory()
+        start_time = time.perf_counter()
+        for author, content in messages:
+            history.add(author, content)
+        build_time = time.perf_counter() - start_time
+
+        repeat = 200 if size <= 1_000 else 5
+        list_time = timed(lambda: list_add_memories(chat_history, BATCH), repeat)
+        store_time = timed(lambda: store_add_memories(history, BATCH), repeat)
+
+        capped = LocationHistory(max_size=size)
+        for author, content in messages:
+            capped.add(author, content)
+        evict_time = timed(lambda: store_add_memories(capped, [(f"u{time.perf_counter_ns()}", "x")]), repeat)
+
+        print(f"{size:>9} entries | build {build_time:.3f}s | add_memories list {list_time * 1e3:9.3f}ms"
+              f" | store {store_time * 1e3:.4f}ms | capped add+evict {evict_time * 1e3:.4f}ms")
+
+    for size in (1_000, 10_000, 100_000):
+        history = LocationHistory()
+        for author, content in fill(size):
+            history.add(author, content)
+
+        index = MemoryIndex()
+        start_time = time.perf_counter()
+        index.add(list(history))
+        embed_time = time.perf_counter() - start_time
+        add_time = timed(lambda: index.add([history.add(f"u{time.perf_counter_ns()}", "a new message")]), 50)
+        search_time = timed(lambda: index.search("what was message number 4242 about", 4), 50)
+
+        print(f"{size:>9} memories | embed {embed_time:.3f}s | index add {add_time * 1e3:.4f}ms"
+              f" | recall top 4 {search_time * 1e3:.3f}ms")
+
+if __name__ == '__main__':
+    main()
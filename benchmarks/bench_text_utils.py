@@ -0,0 +1,111 @@
+"""
+Micro-benchmarks for prompt building helpers at several history sizes, and for message and
+persona text normalization against the earlier multi-pass str.replace/re.sub helpers.
+Uses the weight-free FakeTokenizer unless --model_name points at a tokenizer in models/.
+
+    python -m benchmarks.bench_text_utils
+"""
+import argparse, contextlib, io, re, tempfile, time
+from modules import character
+from modules.character import CharacterPersona
+from modules.fake_backend import FakeTokenizer
+from modules.models import load_tokenizer
+from modules.text_utils import clean_messages, generate_history, generate_temporary_context, replace_name_tokens, token_count_cache
+
+def fake_history(size):
+    return [(f"user{i % 7}", f"message {i} from LLMBot <:smile:12345> about the weather today") for i in range(size)]
+
+# The helpers TextNormalizer replaced, kept here as the baseline
+def legacy_clean_messages(messages, discord_name, char_name):
+    fixed_messages = []
+    for username, message in messages:
+        fixed_message = re.sub(r'<a?(:\w+):\d+>', r'\1:', message.replace(discord_name, char_name))
+        fixed_messages.append((username.replace(discord_name, char_name), fixed_message))
+    return fixed_messages
+
+def legacy_replace_name_tokens(text, char_name, user_name):
+    text = text.replace('{{user}}', user_name).replace('<USER>', user_name)
+    text = text.replace('{{char}}', char_name).replace('<BOT>', char_name)
+    return text
+
+def timed(function, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start_time) / repeat * 1e3
+
+def main(args):
+    tokenizer = load_tokenizer(args.model_name) if args.model_name else FakeTokenizer()
+    persona = CharacterPersona(args.character, False, False)
+    char_name = persona.char_name
+    greeting = persona.generate_greeting()
+    example_dialogue = persona.generate_example_dialogue()
+
+    rows = []
+    for size in args.sizes:
+        history = fake_history(size)
+        current_message = history[0]
+
+        def history_pass():
+            return generate_history(tokenizer, "LLMBot", char_name, current_message, None, history, args.max_tokens)
+
+        clean_time = timed(lambda: clean_messages(history, "LLMBot", char_name), args.repeat)
+
+        token_count_cache.enabled = True
+        history_pass()
+        cached_time = timed(history_pass, args.repeat)
+
+        token_count_cache.enabled = False
+        uncached_time = timed(history_pass, args.repeat)
+        token_count_cache.enabled = True
+
+        reversed_context_memory, remaining_tokens = history_pass()
+        context_time = timed(lambda: generate_temporary_context(tokenizer, reversed_context_memory, greeting,
+                                                                example_dialogue, remaining_tokens), args.repeat)
+
+        rows.append(f"{size:>8}{clean_time:>20.3f}{cached_time:>22.3f}{uncached_time:>16.3f}{context_time:>22.3f}")
+    return rows
+
+def normalization(args):
+    persona = CharacterPersona(args.character, False, False)
+    char_name = persona.char_name
+    persona_text = '\n'.join(filter(None, [persona.char_persona, persona.world_scenario, str(persona.example_dialogue),
+                                           persona.char_greeting]))
+
+    rows = []
+    for size in args.sizes:
+        history = fake_history(size)
+        ids = list(range(size))
+        assert legacy_clean_messages(history, "LLMBot", char_name) == clean_messages(history, "LLMBot", char_name)
+        legacy_time = timed(lambda: legacy_clean_messages(history, "LLMBot", char_name), args.repeat)
+        one_pass_time = timed(lambda: clean_messages(history, "LLMBot", char_name), args.repeat)
+        clean_messages(history, "LLMBot", char_name, ids)
+        memoized_time = timed(lambda: clean_messages(history, "LLMBot", char_name, ids), args.repeat)
+        rows.append(f"{size:>8}{legacy_time:>14.3f}{one_pass_time:>14.3f}{memoized_time:>14.3f}")
+
+    assert legacy_replace_name_tokens(persona_text, char_name, "User") == replace_name_tokens(persona_text, char_name, "User")
+    legacy_time = timed(lambda: legacy_replace_name_tokens(persona_text, char_name, "User"), args.repeat * 20)
+    one_pass_time = timed(lambda: replace_name_tokens.__wrapped__(persona_text, char_name, "User"), args.repeat * 20)
+    memoized_time = timed(lambda: replace_name_tokens(persona_text, char_name, "User"), args.repeat * 20)
+    rows.append(f"{'persona':>8}{legacy_time:>14.4f}{one_pass_time:>14.4f}{memoized_time:>14.4f}")
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model_name", type=str, default=None, help="Tokenizer folder within models, FakeTokenizer if omitted")
+    parser.add_argument("-c", "--character", type=str, default="default_character")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[10, 50, 200, 1000])
+    parser.add_argument("--max_tokens", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    # The helpers print progress on every call, keep that out of the timings and the table
+    # Personas open chat logs, keep them out of logs/
+    with contextlib.redirect_stdout(io.StringIO()), tempfile.TemporaryDirectory() as log_dir:
+        character.LOG_DIR = log_dir
+        rows = main(args)
+        normalization_rows = normalization(args)
+    print(f"{'history':>8}{'clean_messages ms':>20}{'generate_history ms':>22}{'(no cache) ms':>16}{'temporary_context ms':>22}")
+    print('\n'.join(rows))
+    print(f"\n{'messages':>8}{'legacy ms':>14}{'one pass ms':>14}{'memoized ms':>14}")
+    print('\n'.join(normalization_rows))
@@ -0,0 +1,280 @@
+"""
+Offline load test: replays synthetic Discord traffic through MyClient's on_message and slash
+command paths against the fake backend, then reports p50/p95/p99 per pipeline stage.
+Runs on a CPU-only box with no network and no model weights.
+
+    python -m benchmarks.load_test --requests 200 --rate 5 --token_latency 0.01
+"""
+import argparse, asyncio, contextlib, io, itertools, random, resource, tempfile, time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import discord
+import llm_discordbot
+from modules import character
+from modules.character import CharacterPersona
+from modules.models import ChatBotModel
+from modules.replicas import spawn_workers
+from modules.metrics import WASTED_SECONDS
+from modules.scheduler import FairQueue
+
+ids = itertools.count(1)
+
+class FakeAvatar(object):
+    url = "https://placeholder"
+
+
+class FakeUser(object):
+    def __init__(self, name):
+        self.id = next(ids)
+        self.name = name
+        self.display_name = name
+        self.display_avatar = FakeAvatar()
+
+    def mentioned_in(self, message):
+        return self in message.mentions
+
+
+class FakeGuild(object):
+    def __init__(self):
+        self.id = next(ids)
+
+
+class FakeChannel(object):
+    def __init__(self, history_size, users, guild=None):
+        self.id = next(ids)
+        self.guild = guild
+        self.messages = []
+        for i in range(history_size):
+            self.messages.append(FakeMessage(self, random.choice(users), f"past message number {i} about nothing in particular"))
+
+    async def typing(self):
+        pass
+
+    async def history(self, limit=100):
+        for message in reversed(self.messages[-limit:]):
+            yield message
+
+    async def fetch_message(self, message_id):
+        return next(message for message in self.messages if message.id == message_id)
+
+
+class FakeMessage(discord.Message):
+    # Shadow discord.Message's slots and properties with plain attributes
+    id = channel = author = clean_content = reference = mentions = mention_everyone = None
+
+    def __init__(self, channel, author, content, mentions=()):
+        self.id = next(ids)
+        self.channel = channel
+        self.author = author
+        self.clean_content = content
+        self.reference = None
+        self.mentions = list(mentions)
+        self.mention_everyone = False
+
+    async def reply(self, content, **kwargs):
+        await asyncio.sleep(0)
+        return FakeMessage(self.channel, None, content)
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(0)
+        self.clean_content = content
+        return self
+
+    async def delete(self):
+        await asyncio.sleep(0)
+
+
+class FakeResponse(object):
+    def __init__(self):
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    async def defer(self, **kwargs):
+        self.done = True
+
+    async def send_message(self, content=None, **kwargs):
+        self.done = True
+
+
+class FakeFollowup(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def send(self, content=None, wait=False, **kwargs):
+        await asyncio.sleep(0)
+        return FakeMessage(self.channel, None, content)
+
+
+class FakeInteraction(discord.Interaction):
+    user = channel = response = followup = created_at = None
+
+    def __init__(self, channel, user):
+        self.created_at = datetime.now(timezone.utc)
+        self.channel = channel
+        self.user = user
+        self.response = FakeResponse()
+        self.followup = FakeFollowup(channel)
+
+
+class RecordingQueue(FairQueue):
+    """
+    Work queue that keeps every request offered to it in a shared list so timings can be collected afterwards.
+    """
+    def __init__(self, requests, max_size, max_per_user):
+        super().__init__(max_size, max_per_user)
+        self.requests = requests
+
+    def put(self, request):
+        self.requests.append(request)
+        return super().put(request)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def run_load_test(args):
+    random.seed(args.seed)
+    persona = CharacterPersona(args.character, False, False)
+    if args.replicas:
+        # Fake inference worker processes, so replicas generate in parallel like separate devices
+        processes, addresses = spawn_workers(args.replicas, token_latency=args.token_latency)
+        chatbot = ChatBotModel(None, persona, args.params, args.history_limit,
+                               backend="replicas", worker_address=','.join(addresses))
+        chatbot.load()
+        chatbot.backend.processes = processes
+    else:
+        chatbot = ChatBotModel(None, persona, args.params, args.history_limit, backend="fake")
+        chatbot.load()
+        chatbot.backend.token_latency = args.token_latency
+
+    client = llm_discordbot.build_client(args, chatbot)
+    requests = []
+    client.queues = [RecordingQueue(requests, args.max_queue, args.max_user_queue) for _ in client.queues]
+    await client._async_setup_hook()
+    bot_user = FakeUser("LLMBot")
+    client._connection.user = bot_user
+    client._ready.set()
+    client.start_dispatch_loops()
+
+    users = [FakeUser(f"user{i}") for i in range(args.users)]
+    guilds = [FakeGuild() for _ in range(args.guilds)]
+    # The first guild talks as the default persona, every other one gets its own binding, history and log
+    for guild in guilds[1:]:
+        client.personas.bind("guild", guild.id, args.character)
+    channels = [FakeChannel(args.history_size, users, guilds[i % len(guilds)]) for i in range(max(args.channels, len(guilds)))]
+    commands = ["trivia", "random_fact", "inspirational_quote"]
+
+    tasks = []
+    start_time = time.time()
+    for _ in range(args.requests):
+        await asyncio.sleep(random.expovariate(args.rate))
+        channel = random.choice(channels)
+        user = users[0] if random.random() < args.hot_user else random.choice(users)
+        if random.random() < args.command_ratio:
+            interaction = FakeInteraction(channel, user)
+            callback = client.tree.get_command(random.choice(commands)).callback
+            tasks.append(asyncio.create_task(callback(interaction)))
+        else:
+            message = FakeMessage(channel, user, f"hey @{bot_user.name} what do you think?", mentions=[bot_user])
+            channel.messages.append(message)
+            tasks.append(asyncio.create_task(client.on_message(message)))
+            if random.random() < args.delete_ratio:
+                tasks.append(asyncio.create_task(delete_later(client, message, random.uniform(0, args.delete_within))))
+
+    # Every request is queued or answered from the response cache once its handler returns
+    await asyncio.gather(*tasks)
+    while any(request.sent_time is None and request.dropped is None for request in requests):
+        await asyncio.sleep(0.01)
+    total_time = time.time() - start_time
+
+    router_report = client.router.report() + f"\npersonas: {client.personas.report()}"
+    await client.close()
+    persona.close()
+    return requests, total_time, client.batch_stats, client.response_cache, router_report
+
+
+async def delete_later(client, message, delay):
+    await asyncio.sleep(delay)
+    message.channel.messages.remove(message)
+    await client.on_raw_message_delete(SimpleNamespace(channel_id=message.channel.id, message_id=message.id))
+
+
+def report(requests, total_time, batch_stats, response_cache, router_report):
+    dropped = [request.dropped for request in requests if request.dropped]
+    requests = [request for request in requests if request.dropped is None]
+    stages = {
+        "prompt build": [request.build_time for request in requests if request.instruct is None],
+        "queue wait": [request.start_time - request.enqueue_time for request in requests],
+        "generation": [request.end_time - request.start_time for request in requests],
+        "send": [request.sent_time - request.end_time for request in requests],
+        "end to end": [request.sent_time - request.enqueue_time + request.build_time for request in requests],
+    }
+    print(f"{len(requests)} generated requests in {total_time:.2f}s ({len(requests) / total_time:.2f} req/s)")
+    print(f"{'stage':<14}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, values in stages.items():
+        print(f"{stage:<14}" + ''.join(f"{percentile(values, pct) * 1e3:>10.2f}" for pct in (50, 95, 99)))
+    print(f"dropped or cancelled: {dropped.count('superseded')} superseded, {dropped.count('busy')} busy, "
+          f"{dropped.count('deleted')} deleted, {dropped.count('expired')} expired, "
+          f"{WASTED_SECONDS.total():.2f}s of generation wasted")
+    prompt_tokens = [len(request.prompt) for request in requests if request.instruct is None]
+    if prompt_tokens:
+        print(f"chat prompt tokens: {sum(prompt_tokens) / len(prompt_tokens):.1f} avg, {percentile(prompt_tokens, 95)} p95")
+    print(batch_stats.report())
+    print(f"response cache: {response_cache.stats()}")
+    print(router_report)
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=100, help="Total requests to replay")
+    parser.add_argument("--rate", type=float, default=5.0, help="Mean arrivals per second (Poisson)")
+    parser.add_argument("--command_ratio", type=float, default=0.3, help="Fraction of requests that are slash commands")
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--guilds", type=int, default=1, help="Spread the channels over this many guilds, each bound to its own persona")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--hot_user", type=float, default=0.0, help="Fraction of requests sent by one spamming user")
+    parser.add_argument("--history_size", type=int, default=50, help="Messages already in each channel")
+    parser.add_argument("--token_latency", type=float, default=0.01, help="Fake backend seconds per generated token")
+    parser.add_argument("--delete_ratio", type=float, default=0.0, help="Fraction of chat messages deleted shortly after they are sent")
+    parser.add_argument("--delete_within", type=float, default=2.0, help="Deleted messages go within this many seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replicas", type=int, default=0, help="Spawn this many fake inference worker processes instead of one in-process backend")
+    parser.add_argument("--verbose", action="store_true", help="Keep the bot's own logging")
+    # Bot settings, same names as llm_discordbot.py
+    parser.add_argument("-c", "--character", type=str, default="default_character")
+    parser.add_argument("-p", "--params", type=str, default="default_params")
+    parser.add_argument("-hl", "--history_limit", default=10, type=int)
+    parser.add_argument("-bs", "--batch_size", default=4, type=int)
+    parser.add_argument("-s", "--stream", action="store_true")
+    parser.add_argument("-mq", "--max_queue", default=32, type=int)
+    parser.add_argument("-muq", "--max_user_queue", default=3, type=int)
+    parser.add_argument("-rt", "--request_timeout", default=300, type=float)
+    parser.add_argument("-rct", "--response_cache_ttl", default=3600, type=float)
+    parser.add_argument("-rps", "--response_pool_size", default=4, type=int)
+    parser.add_argument("-sa", "--summarize_after", default=0, type=int)
+    parser.add_argument("-ab", "--adaptive_budget", action="store_true")
+    parser.add_argument("-slo", "--latency_slo", default=15.0, type=float)
+    parser.add_argument("-mct", "--min_context_tokens", default=1024, type=int)
+    parser.add_argument("-mnt", "--min_new_tokens", default=64, type=int)
+    parser.add_argument("-mhl", "--min_history_limit", default=3, type=int)
+    parser.add_argument("-pdc", "--permanent_dialogue_context", action="store_true")
+    parser.add_argument("-pl", "--persistent_logs", action="store_true")
+    parser.add_argument("-ml", "--memory_limit", default=None, type=int)
+    parser.add_argument("-rm", "--recall_memories", default=0, type=int)
+    parser.add_argument("-pb", "--persona_bindings", type=str, default=None)
+    parser.add_argument("-mlp", "--max_loaded_personas", default=32, type=int)
+    args = parser.parse_args()
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    # Replies are logged like in the bot, keep those logs out of logs/
+    with output, tempfile.TemporaryDirectory() as log_dir:
+        character.LOG_DIR = log_dir
+        results = asyncio.run(run_load_test(args))
+    report(*results)
@@ -1,26 +1,59 @@
+import time
+IMPORT_START = time.time()
 import discord
 import asyncio
 import argparse
-from typing import List
+import logging
+from typing import List, Literal
 from concurrent.futures import ThreadPoolExecutor
-from discord.ext import commands, tasks
+from discord.ext import commands
 from modules.models import ChatBotModel
 from modules.character import CharacterPersona
-from modules.utils import load_json
+from modules.personas import PersonaRegistry
+from modules.scheduler import GenerationRequest, FairQueue, BatchStats, drain_queue
+from modules.history import ChannelHistoryMirror
+from modules.streaming import StreamingReply
+from modules.text_utils import token_count_cache
+from modules.response_cache import ResponseCache
+from modules.summarizer import ConversationSummaries
+from modules.budget import BudgetController
+from modules.replicas import Router
+from modules.metrics import REQUESTS, RESPONSE_CACHE, DROPPED, CANCELLED, WASTED_SECONDS, ERRORS, SUMMARIES, QUEUE_DEPTH, QUEUE_WAIT, SEND_SECONDS, summary, start_metrics_server
+from modules.utils import load_json, startup_timer
+
+logger = logging.getLogger("llm_discordbot")
+
+BUSY_MESSAGE = "I'm swamped right now, try again in a minute."
+# Interaction tokens expire 15 minutes after the command, minus a margin for sending
+INTERACTION_TIMEOUT = 15 * 60 - 30
 
 #######################
 # load in config file #
 #######################
 
-config = load_json('config/config.json')
+config = {}
+REQUIRED_ROLE_NAME = None
+GUILDS = []
+MY_ID = None
+key = None
 
-REQUIRED_ROLE_NAME = config['required_role_name']
-MY_GUILD = discord.Object(id=config['my_guild'])
-MY_ID = config['my_id']
-key = config['key']
+def load_config(config_path='config/config.json'):
+    """
+    Load the bot and server settings. Called at startup rather than import time so the
+    client can be built offline (e.g. by the benchmarks) without a filled-in config.
+    """
+    global config, REQUIRED_ROLE_NAME, GUILDS, MY_ID, key
+    config = load_json(config_path)
+
+    REQUIRED_ROLE_NAME = config['required_role_name']
+    # "guilds" lists every server the bot serves, "my_guild" is the single server form
+    GUILDS = [discord.Object(id=guild_id) for guild_id in config.get('guilds') or [config['my_guild']]]
+    MY_ID = config['my_id']
+    key = config['key']
 
 class MyClient(discord.Client):
-    def __init__(self, *, intents: discord.Intents, chatbot):
+    def __init__(self, *, intents: discord.Intents, chatbot, batch_size=1, stream=False, response_cache=None,
+                 max_queue=32, max_user_queue=3, summaries=None, budget=None, request_timeout=300, personas=None):
         super().__init__(intents=intents)
         """
         A CommandTree is a special type that holds all the application command
@@ -29,78 +62,471 @@ class MyClient(discord.Client):
         """
 
         self.tree = discord.app_commands.CommandTree(self)
-        self.queue = asyncio.Queue() 
         self.chatbot = chatbot
+        # Persona bound to each guild and channel, all served by chatbot's one model
+        self.personas = personas or PersonaRegistry(chatbot.character_persona, None)
+        self.batch_size = batch_size
+        self.stream = stream
+        self.batch_stats = BatchStats()
+        self.history_mirror = ChannelHistoryMirror()
+        self.response_cache = response_cache or ResponseCache()
+        # Rolling per-channel summaries of older messages, None when disabled
+        self.summaries = summaries
+        # Load-adaptive prompt and reply budgets for chat, None when disabled
+        self.budget = budget
+        # Seconds a chat reply is still worth sending, 0 for no deadline
+        self.request_timeout = request_timeout
+        # Queued and generating chat requests by the id of the message they reply to, so deletes can cancel them
+        self.active = {}
+
+        # One queue, dispatch loop and generation thread per model replica for the lifetime of the client
+        replicas = chatbot.replica_count
+        self.router = Router(replicas)
+        self.queues = [FairQueue(max_queue, max_user_queue) for _ in range(replicas)]
+        self.executors = [ThreadPoolExecutor(max_workers=1) for _ in range(replicas)]
+        self.dispatch_tasks = [None] * replicas
+
+        # Resolves once the chatbot has finished loading in the background
+        self.model_ready = None
 
     async def setup_hook(self):
         """
-        This copies the global commands over to your guild.
+        This copies the global commands over to your guilds.
+        """
+        for guild in GUILDS:
+            self.tree.copy_global_to(guild=guild)
+            await self.tree.sync(guild=guild)
+
+        # Start the dispatch loops once; on_ready can fire again on reconnect
+        self.start_dispatch_loops()
+
+    async def close(self):
         """
-        self.tree.copy_global_to(guild=MY_GUILD)
-        await self.tree.sync(guild=MY_GUILD)
+        Stop the dispatch loops and generation threads before closing the connection.
+        """
+        for replica, task in enumerate(self.dispatch_tasks):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                self.dispatch_tasks[replica] = None
+        for executor in self.executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if self.chatbot.backend:
+            self.chatbot.backend.close()
+        self.personas.close()
+        await super().close()
 
     async def on_ready(self):
         """
         Event handler for when the bot is ready.
         """
+        startup_timer.stop("gateway connect")
         await self.change_presence(activity=discord.Game(name="A.I. World Domination"))
 
-        # Update bot's nickname
-        guild = self.get_guild(MY_GUILD.id)
-        member = guild.get_member(self.user.id)
-        await member.edit(nick=self.chatbot.character_name)
+        # A new gateway session may have missed message events
+        self.history_mirror.invalidate()
 
-        print(f"Logged in as {self.user} (ID: {self.user.id}, nickname: {self.chatbot.character_name})\n------")
-    
-        # Start background task
-        self.background_task.start()
+        # Nickname the bot after the persona each guild is bound to
+        for guild in filter(None, (self.get_guild(guild.id) for guild in GUILDS)):
+            persona = self.personas.persona(guild.id)
+            await guild.get_member(self.user.id).edit(nick=persona.char_name)
+            print(f"Logged in to {guild.name} as {self.user} (ID: {self.user.id}, nickname: {persona.char_name})")
+        print("------")
 
-    @tasks.loop(seconds=5.0)
-    async def background_task(self):
+    def start_dispatch_loops(self):
+        for replica in range(len(self.queues)):
+            self.start_dispatch_loop(replica)
+
+    def start_dispatch_loop(self, replica: int):
+        """
+        Start a replica's dispatch loop and have it restart itself if it crashes.
+        """
+        task = asyncio.create_task(self.dispatch_loop(replica))
+        task.add_done_callback(lambda task: self.on_dispatch_done(replica, task))
+        self.dispatch_tasks[replica] = task
+
+    def on_dispatch_done(self, replica: int, task: asyncio.Task):
+        if task.cancelled() or self.is_closed() or self.model_failed():
+            return
+        ERRORS.inc(stage="dispatch")
+        print(f"Dispatch loop {replica} crashed: {task.exception()!r}, restarting")
+        self.start_dispatch_loop(replica)
+
+    async def dispatch_loop(self, replica: int):
         """
-        Background task to process prompts and generate replies using the chatbot model.
+        Consume prompts queued for one replica as soon as they arrive and generate their replies in batches.
         """
         print("Waiting...")
         await self.wait_until_ready()
-        print("Model loaded, ready for generation.")
-
-        with ThreadPoolExecutor(max_workers=1) as executor:
-            discord_obj, prompt, instruct = await self.queue.get()
-            print("Message fetched from queue")
-
-            current_channel = discord_obj.channel
-            await current_channel.typing()
-            response = await self.generate_reply(prompt, executor)
- 
-
-            print(f"|| Prompt ||\n{prompt}\n\n||Response||\n{response}\n")
-
-            if type(discord_obj) == discord.Message:
-                print("responding to message")
-                await discord_obj.reply(response)
-            elif type(discord_obj) == discord.Interaction:
-                user = discord_obj.user
-                embed = create_embed(instruct, user)
-                if not discord_obj.response.is_done():
-                    print("responding to interaction")
-                    await discord_obj.response.send_message(content=response, embed=embed)
+        await self.wait_for_model()
+        print(f"Model loaded, replica {replica} ready for generation.")
+
+        queue = self.queues[replica]
+        while True:
+            # Spend idle generation time topping up pooled instruct replies
+            if queue.empty():
+                refills = self.response_cache.refill_batch(self.batch_size)
+                if refills:
+                    await self.refill_response_cache(refills, replica)
+                    continue
+                refresh = self.summaries.next_refresh() if self.summaries else None
+                if refresh:
+                    await self.refresh_summary(*refresh, replica=replica)
+                    continue
+
+            # Token streaming works on one sequence at a time
+            batch = await drain_queue(queue, 1 if self.stream else self.batch_size)
+            QUEUE_DEPTH.set(sum(queue.qsize() for queue in self.queues))
+            print(f"{len(batch)} message(s) fetched from queue {replica}")
+
+            # Skip requests whose message was deleted or whose deadline passed while they waited
+            now = time.time()
+            stale = [request for request in batch if request.stale(now)]
+            for request in stale:
+                self.drop(request, request.cancelled)
+            batch = [request for request in batch if not request.cancelled]
+            if not batch:
+                continue
+
+            try:
+                if self.stream:
+                    await self.process_streaming(batch[0], replica)
                 else:
-                    await discord_obj.followup.send(content=response, embed=embed)
-    
-    
-    async def generate_reply(self, prompt, executor):
+                    await self.process_batch(batch, replica)
+            finally:
+                self.router.done(replica, len(batch))
+                for request in batch:
+                    self.finish(request)
+
+    async def wait_for_model(self):
+        """
+        Wait for the chatbot's background load to finish. Raises if loading failed.
+        """
+        if self.model_ready is None:
+            self.model_ready = asyncio.wrap_future(self.chatbot.ready)
+            self.model_ready.add_done_callback(self.on_model_loaded)
+        # Shielded so a cancelled waiter does not cancel the shared future
+        await asyncio.shield(self.model_ready)
+
+    def on_model_loaded(self, future: asyncio.Future):
+        if future.exception():
+            print(f"Model failed to load: {future.exception()!r}, shutting down")
+            asyncio.create_task(self.close())
+            return
+        self.router.replicas = self.chatbot.replicas
+        self.personas.set_tokenizer(self.chatbot.tokenizer)
+        print(f"|| Startup phases: {startup_timer.report()} ||")
+
+    def model_failed(self) -> bool:
+        return bool(self.model_ready and self.model_ready.done() and self.model_ready.exception())
+
+    async def process_batch(self, batch: List[GenerationRequest], replica: int = 0):
         """
-        Generate a reply using the chatbot model given a prompt.
+        Generate a batch of replies and send each one once the whole batch is done.
         """
+        for channel in {request.discord_obj.channel for request in batch}:
+            await channel.typing()
+
+        start_time = time.time()
+        for request in batch:
+            QUEUE_WAIT.observe(start_time - request.enqueue_time)
+        timers = self.schedule_deadlines(batch)
+        try:
+            # Prompts in a batch may belong to different personas; the prefix only matters for single prompts
+            responses, tokens_generated = await self.generate_replies([request.prompt for request in batch], remember=False,
+                                                                      replica=replica, params=self.generation_params(batch),
+                                                                      cancel_events=[request.cancel_event for request in batch],
+                                                                      persona=batch[0].persona)
+        finally:
+            for timer in timers:
+                timer.cancel()
+        end_time = time.time()
+        self.batch_stats.record(batch, tokens_generated, end_time - start_time, start_time)
+        print(f"|| Batch stats ||\n{self.batch_stats.report()}\n")
+
+        # Cancelled sequences still cost their share of the batch up to when they stopped
+        for request, response in zip(batch, responses):
+            if not request.cancelled:
+                self.chatbot.remember_replies([response], request.persona)
+        for request, response in zip(batch, responses):
+            request.start_time, request.end_time = start_time, end_time
+            if request.cancelled:
+                self.discard(request, (end_time - start_time) / len(batch))
+                continue
+            if request.cache_key:
+                self.response_cache.served(request.cache_key, response)
+            logger.debug("|| Prompt ||\n%s\n\n||Response||\n%s\n", request.prompt, response)
+            try:
+                await self.send_reply(request, response)
+            except discord.DiscordException as e:
+                ERRORS.inc(stage="send")
+                print(f"Failed to send reply: {e!r}")
+            request.sent_time = time.time()
+            SEND_SECONDS.observe(request.sent_time - end_time)
+            self.observe_latency(request)
+            print(f"|| Time to first visible text: {request.sent_time - request.enqueue_time:.2f}s (non-streaming) ||")
+
+    async def process_streaming(self, request: GenerationRequest, replica: int = 0):
+        """
+        Post a placeholder reply right away and edit it as the response is generated.
+        """
+        reply = StreamingReply(await self.send_placeholder(request))
+        edit_task = asyncio.create_task(reply.run())
+
         loop = asyncio.get_running_loop()
-        response = await loop.run_in_executor(executor, self.chatbot.generate_reply, prompt)
-        return response
+        def text_callback(text, stream_end):
+            loop.call_soon_threadsafe(reply.feed, text)
+
+        request.start_time = time.time()
+        QUEUE_WAIT.observe(request.start_time - request.enqueue_time)
+        timers = self.schedule_deadlines([request])
+        try:
+            responses, tokens_generated = await self.generate_replies([request.prompt], text_callback, remember=False,
+                                                                      replica=replica, params=self.generation_params([request]),
+                                                                      cancel_events=[request.cancel_event], persona=request.persona)
+        finally:
+            edit_task.cancel()
+            for timer in timers:
+                timer.cancel()
+        request.end_time = time.time()
+        self.batch_stats.record([request], tokens_generated, request.end_time - request.start_time, request.start_time)
+        print(f"|| Batch stats ||\n{self.batch_stats.report()}\n")
+
+        if request.cancelled:
+            self.discard(request, request.end_time - request.start_time)
+            try:
+                await reply.message.delete()
+            except discord.DiscordException as e:
+                print(f"Failed to delete placeholder: {e!r}")
+            return
+
+        response = responses[0]
+        self.chatbot.remember_replies([response], request.persona)
+        if request.cache_key:
+            self.response_cache.served(request.cache_key, response)
+        logger.debug("|| Prompt ||\n%s\n\n||Response||\n%s\n", request.prompt, response)
+        try:
+            await reply.finish(edit_task, response)
+        except discord.DiscordException as e:
+            ERRORS.inc(stage="send")
+            print(f"Failed to send reply: {e!r}")
+        request.sent_time = time.time()
+        SEND_SECONDS.observe(request.sent_time - request.end_time)
+        self.observe_latency(request)
+        if reply.first_visible_time:
+            print(f"|| Time to first visible text: {reply.first_visible_time - request.enqueue_time:.2f}s (streaming, {reply.edits} edits) ||")
+
+    def schedule_deadlines(self, batch: List[GenerationRequest]):
+        """
+        Cancel each request's generation when its deadline passes. Returns the timer handles.
+        """
+        loop = asyncio.get_running_loop()
+        return [loop.call_later(max(request.deadline - time.time(), 0), request.cancel, "expired")
+                for request in batch if request.deadline is not None]
+
+    def discard(self, request: GenerationRequest, seconds: float):
+        """
+        Count a reply cancelled during generation and the generation time it cost.
+        """
+        request.dropped = request.cancelled
+        CANCELLED.inc(reason=request.cancelled)
+        WASTED_SECONDS.inc(seconds, reason=request.cancelled)
+        print(f"|| Cancelled {request.lane} request from channel {request.channel_id} after {seconds:.2f}s "
+              f"of generation: {request.cancelled} ||")
+
+    def cancel_message(self, message_id: int, reason: str):
+        """
+        Cancel the chat request replying to message_id, if one is queued or generating.
+        """
+        request = self.active.get(message_id)
+        if request is not None:
+            request.cancel(reason)
+
+    def finish(self, request: GenerationRequest):
+        if request.lane == "chat":
+            self.active.pop(request.discord_obj.id, None)
+        self.personas.unpin(request.persona)
+
+    def generation_params(self, batch: List[GenerationRequest]):
+        """
+        Params for a batch when the budget controller shortened its replies, otherwise None for the configured params.
+        A batch gets the longest length any of its requests is allowed.
+        """
+        if any(request.max_new_tokens is None for request in batch):
+            return None
+        max_new_tokens = max(request.max_new_tokens for request in batch)
+        if max_new_tokens >= self.chatbot.params.get("max_new_tokens", max_new_tokens):
+            return None
+        return dict(self.chatbot.params, max_new_tokens=max_new_tokens)
+
+    def observe_latency(self, request: GenerationRequest):
+        if self.budget and request.lane == "chat":
+            self.budget.observe(request.sent_time - request.enqueue_time + request.build_time)
+
+    async def refill_response_cache(self, refills, replica: int = 0):
+        """
+        Generate replies for sampled instruct prompts and add them to their pools.
+        """
+        keys = [key for key, _ in refills]
+        try:
+            responses, _ = await self.generate_replies([prompt for _, prompt in refills], remember=False, replica=replica)
+        except Exception as e:
+            print(f"Response cache refill failed: {e!r}")
+            self.response_cache.forget(keys)
+            return
+        for key, response in zip(keys, responses):
+            self.response_cache.put(key, response)
+        print(f"|| Response cache refilled: {self.response_cache.stats()} ||")
+
+    async def refresh_summary(self, channel_id, previous_summary, messages, replica: int = 0):
+        """
+        Fold a channel's pending (id, message) pairs into its rolling summary.
+        """
+        persona = self.personas.persona(channel_id=channel_id)
+        prompt = self.chatbot.generate_summary_prompt(previous_summary, [message for _, message in messages], persona)
+        params = dict(self.chatbot.params, max_new_tokens=self.summaries.summary_tokens)
+        try:
+            responses, _ = await self.generate_replies([prompt], remember=False, replica=replica, params=params)
+        except Exception as e:
+            print(f"Summary refresh failed: {e!r}")
+            SUMMARIES.inc(result="failed")
+            self.summaries.fail(channel_id)
+            return
+        if not responses[0]:
+            SUMMARIES.inc(result="failed")
+            self.summaries.fail(channel_id)
+            return
+        SUMMARIES.inc(result="ok")
+        self.summaries.complete(channel_id, responses[0], messages[-1][0])
+        print(f"|| Summary of channel {channel_id} now covers {len(messages)} more messages: {self.summaries.stats()} ||")
+
+    async def submit_instruct(self, interaction: discord.Interaction, prompt: str, instruct: str):
+        """
+        Answer an instruct command from the response cache, or queue it for generation.
+        """
+        request = GenerationRequest(interaction, prompt, instruct)
+        request.persona = self.persona_for(interaction.channel)
+        request.deadline = interaction.created_at.timestamp() + INTERACTION_TIMEOUT
+        params = self.chatbot.params
+        request.cache_key = self.response_cache.make_key(prompt, params, self.chatbot.model_name)
+        response = self.response_cache.get(request.cache_key, prompt, deterministic=not params.get("do_sample", False))
+        if response is None:
+            if self.response_cache.enabled:
+                RESPONSE_CACHE.inc(result="miss")
+            await self.enqueue(request)
+            return
+
+        RESPONSE_CACHE.inc(result="hit")
+        self.chatbot.remember_replies([response], request.persona)
+        request.start_time = request.end_time = time.time()
+        await self.send_reply(request, response)
+        request.sent_time = time.time()
+        SEND_SECONDS.observe(request.sent_time - request.end_time)
+
+    async def send_placeholder(self, request: GenerationRequest):
+        """
+        Send the initial streaming message and return it so it can be edited.
+        """
+        discord_obj = request.discord_obj
+        if isinstance(discord_obj, discord.Message):
+            return await discord_obj.reply("...")
+        elif isinstance(discord_obj, discord.Interaction):
+            embed = create_embed(request.instruct, discord_obj.user)
+            if not discord_obj.response.is_done():
+                await discord_obj.response.send_message(content="...", embed=embed)
+                return await discord_obj.original_response()
+            return await discord_obj.followup.send(content="...", embed=embed, wait=True)
+
+    async def send_reply(self, request: GenerationRequest, response: str):
+        """
+        Send a generated response back to the Message or Interaction that requested it.
+        """
+        discord_obj = request.discord_obj
+        if isinstance(discord_obj, discord.Message):
+            print("responding to message")
+            await discord_obj.reply(response)
+        elif isinstance(discord_obj, discord.Interaction):
+            user = discord_obj.user
+            embed = create_embed(request.instruct, user)
+            if not discord_obj.response.is_done():
+                print("responding to interaction")
+                await discord_obj.response.send_message(content=response, embed=embed)
+            else:
+                await discord_obj.followup.send(content=response, embed=embed)
+
+    async def generate_replies(self, prompts, text_callback=None, remember=True, replica=0, params=None, cancel_events=None,
+                               persona=None):
+        """
+        Generate replies for a batch of prompts on one replica of the chatbot model.
+        Replies are remembered here on the event loop so replicas never write memories concurrently.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            responses, tokens_generated = await loop.run_in_executor(self.executors[replica], self.chatbot.generate_replies,
+                                                                     prompts, text_callback, False, replica, params,
+                                                                     cancel_events, persona)
+        except Exception:
+            ERRORS.inc(stage="generation")
+            raise
+        if remember:
+            self.chatbot.remember_replies(responses, persona)
+        return responses, tokens_generated
+
+    async def enqueue(self, request: GenerationRequest):
+        """
+        Queue a request on the replica the router picks for its channel, dropping chat requests
+        it supersedes. Replies with a busy message right away if that replica's queue is full.
+        """
+        REQUESTS.inc(kind=request.lane)
+        # Released by finish(), once the reply is remembered or the request dropped
+        self.personas.pin(request.persona)
+        if request.lane == "chat":
+            for queue in self.queues:
+                for superseded in queue.supersede(request.channel_id):
+                    self.drop(superseded, "superseded")
+            # A reply to the same user's previous message in this channel would arrive out of date
+            for active in list(self.active.values()):
+                if active.channel_id == request.channel_id and active.user_id == request.user_id:
+                    active.cancel("superseded")
+            if self.request_timeout:
+                request.deadline = request.enqueue_time + self.request_timeout
+
+        request.replica = self.router.route(request.channel_id)
+        if self.queues[request.replica].put(request):
+            if request.lane == "chat":
+                self.active[request.discord_obj.id] = request
+        else:
+            self.drop(request, "busy")
+            try:
+                await self.send_reply(request, BUSY_MESSAGE)
+            except discord.DiscordException as e:
+                ERRORS.inc(stage="send")
+                print(f"Failed to send busy reply: {e!r}")
+            request.sent_time = time.time()
+        QUEUE_DEPTH.set(sum(queue.qsize() for queue in self.queues))
+
+    def drop(self, request: GenerationRequest, reason: str):
+        request.dropped = reason
+        self.router.release(request.replica)
+        self.finish(request)
+        DROPPED.inc(reason=reason)
+        print(f"|| Dropped {request.lane} request from channel {request.channel_id}: {reason} ||")
     
     
     ####################
     # Helper Functions #
     ####################
 
+    def persona_for(self, channel) -> CharacterPersona:
+        """
+        The persona bound to a channel or its guild, or the default one.
+        """
+        guild = getattr(channel, "guild", None)
+        return self.personas.persona(guild.id if guild else None, channel.id)
+
     def should_process_message(self, current_message: discord.Message) -> bool:
         """
         Determine if the bot should process the given message.
@@ -109,19 +535,41 @@ class MyClient(discord.Client):
             isinstance(current_message.channel, discord.channel.DMChannel) or self.user.mentioned_in(current_message)
         )
 
-    async def get_last_message_if_referenced(self, current_message: discord.Message) -> discord.Message:
-        "Retrieve the last message if the current message is a reply to it."
-        if current_message.reference:
-            return await current_message.channel.fetch_message(current_message.reference.message_id)
-        return None
+    async def get_last_message_if_referenced(self, current_message: discord.Message) -> tuple[int, tuple[str, str]]:
+        """
+        Retrieve the (id, cleaned message) of the message the current message replies to, if any.
+        """
+        reference = current_message.reference
+        if not reference:
+            return None
+
+        if isinstance(reference.resolved, discord.Message):
+            return reference.resolved.id, self.clean_single_message(reference.resolved)
 
-    async def fetch_past_messages(self, channel: discord.abc.Messageable) -> List[discord.Message]:
+        cached = self.history_mirror.get(current_message.channel.id, reference.message_id)
+        if cached:
+            return reference.message_id, cached
+
+        last_message = await current_message.channel.fetch_message(reference.message_id)
+        return last_message.id, self.clean_single_message(last_message)
+
+    async def fetch_past_messages(self, channel: discord.abc.Messageable) -> List[tuple[int, tuple[str, str]]]:
         """
-        Fetch past messages from the channel up to the message history limit.
+        Fetch (id, cleaned message) pairs from the channel up to the message history limit,
+        reading from the history mirror and falling back to REST on a cold start or gap.
         """
-        message_history = [message async for message in channel.history(limit=self.chatbot.message_history_limit)]
-        print(f"Fetched: {chatbot.message_history_limit} messages")
-        return message_history
+        limit = self.budget.history_limit if self.budget else self.chatbot.message_history_limit
+        message_history = self.history_mirror.history(channel.id, limit)
+        if message_history is not None:
+            print(f"Read: {len(message_history)} messages from history mirror")
+            return message_history
+
+        messages = [message async for message in channel.history(limit=limit)]
+        print(f"Fetched: {limit} messages")
+        self.history_mirror.seed(channel.id,
+                                 [(message.id, self.clean_single_message(message)) for message in messages],
+                                 complete=len(messages) < limit)
+        return self.history_mirror.history(channel.id, limit) or [(message.id, self.clean_single_message(message)) for message in messages]
 
 
     def clean_single_message(self, message: discord.Message) -> tuple[str, str]:
@@ -131,13 +579,6 @@ class MyClient(discord.Client):
         return message.author.display_name.strip(), message.clean_content.strip()
 
 
-    def clean_message_history(self, message_history: List[discord.Message]) -> List[tuple[str, str]]:
-        """
-        Clean the message history by extracting display names and clean contents for each message.
-        """
-        print("Cleaned History")
-        return [self.clean_single_message(message) for message in message_history]
-
 def has_required_role():
     """
     Check if the user has the required role to perform a command.
@@ -153,14 +594,26 @@ def create_embed(prompt, user):
     return embed
 
 
-def main(args: argparse.Namespace, chatbot: ChatBotModel):
+def build_client(args: argparse.Namespace, chatbot: ChatBotModel) -> MyClient:
     """
-    The main function to start the Discord bot and handle events.
+    Create the client and register its events and commands.
     """
     intents = discord.Intents.default()
     intents.members = True
     intents.message_content = True
-    client = MyClient(intents=intents, chatbot=chatbot)
+    response_cache = ResponseCache(ttl=args.response_cache_ttl, pool_size=args.response_pool_size)
+
+    def load_persona(character, log_tag):
+        return CharacterPersona(character, args.permanent_dialogue_context, args.persistent_logs, args.memory_limit,
+                                args.recall_memories, log_tag)
+    personas = PersonaRegistry(chatbot.character_persona, load_persona, args.persona_bindings, args.max_loaded_personas)
+
+    client = MyClient(intents=intents, chatbot=chatbot, batch_size=args.batch_size, stream=args.stream,
+                      response_cache=response_cache, max_queue=args.max_queue, max_user_queue=args.max_user_queue,
+                      summaries=ConversationSummaries(args.summarize_after) if args.summarize_after else None,
+                      budget=BudgetController(args.min_context_tokens, args.min_new_tokens, args.min_history_limit,
+                                              args.latency_slo) if args.adaptive_budget else None,
+                      request_timeout=args.request_timeout, personas=personas)
 
     @client.tree.command(name='sync', description='Owner only')
     async def sync(interaction: discord.Interaction):
@@ -171,6 +624,19 @@ def main(args: argparse.Namespace, chatbot: ChatBotModel):
         else:
             await interaction.response.send_message('You must be the owner to use this command!')
 
+    @client.tree.command(name='stats', description='Owner only')
+    async def stats(interaction: discord.Interaction):
+        if interaction.user.id == MY_ID:
+            await interaction.response.send_message(f"```\n{summary()}\n{token_count_cache.stats()}\n"
+                                                    f"Response cache: {client.response_cache.stats()}\n"
+                                                    f"{client.router.report()}\n"
+                                                    f"Summaries: {client.summaries.stats() if client.summaries else 'off'}\n"
+                                                    f"Budget: {client.budget.report() if client.budget else 'off'}\n"
+                                                    f"Personas: {client.personas.report()}\n"
+                                                    f"Startup: {startup_timer.report()}\n```", ephemeral=True)
+        else:
+            await interaction.response.send_message('You must be the owner to use this command!')
+
     ############################
     # Primary Message Commands #
     ############################
@@ -180,27 +646,70 @@ def main(args: argparse.Namespace, chatbot: ChatBotModel):
         """
         Event handler for when a message is sent in a channel the bot can read.
         """
+        build_start = time.time()
+        client.history_mirror.add(current_message.channel.id, current_message.id,
+                                  client.clean_single_message(current_message))
+
         if not client.should_process_message(current_message):
             return
 
         client.chatbot.discord_name = client.user.name
 
+        # Prompts need the tokenizer, so mentions that arrive during startup wait for the model
+        await client.wait_for_model()
+
+        chatbot = client.chatbot
+        if client.budget:
+            client.budget.set_ceilings(chatbot.max_tokens, chatbot.params.get("max_new_tokens", 300), chatbot.message_history_limit)
+            client.budget.update(sum(queue.qsize() for queue in client.queues))
+
         message_history = await client.fetch_past_messages(current_message.channel)
         last_message = await client.get_last_message_if_referenced(current_message)
 
-        if last_message and (last_message in message_history):
+        if last_message and (last_message[0] in {message_id for message_id, _ in message_history}):
             print("Last message was in history, removed from context")
             last_message = None
     
-        message_history_clean = client.clean_message_history(message_history)
         current_message_clean = client.clean_single_message(current_message)
-        last_message_clean = client.clean_single_message(last_message) if last_message else None
+        last_message_clean = last_message[1] if last_message else None
+
+        conversation_summary = None
+        if client.summaries:
+            conversation_summary, message_history = client.summaries.apply(current_message.channel.id, message_history)
+        message_history_clean = [message for _, message in message_history]
+
+        persona = client.persona_for(current_message.channel)
+        prompt = chatbot.generate_prompt(current_message_clean, last_message_clean, message_history_clean,
+                                         conversation_summary, client.budget.max_tokens if client.budget else None,
+                                         history_ids=[message_id for message_id, _ in message_history], persona=persona)
+        logger.debug("Prompt Generated:\n%s", prompt)
 
-        prompt = client.chatbot.generate_prompt(current_message_clean, last_message_clean, message_history_clean)
-        print("Prompt Generated:")
-        print(prompt)
+        request = GenerationRequest(current_message, prompt, build_start=build_start)
+        request.persona = persona
+        if client.budget:
+            request.max_new_tokens = client.budget.new_tokens
+        await client.enqueue(request)
 
-        await client.queue.put((current_message, prompt, None))
+    @client.event
+    async def on_message_edit(before: discord.Message, after: discord.Message):
+        client.history_mirror.edit(after.channel.id, after.id, client.clean_single_message(after))
+
+    @client.event
+    async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+        # Edits to messages outside discord.py's cache cannot be re-cleaned, so refetch that channel
+        if payload.cached_message is None and client.history_mirror.contains(payload.channel_id, payload.message_id):
+            client.history_mirror.invalidate(payload.channel_id)
+
+    @client.event
+    async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+        client.history_mirror.delete(payload.channel_id, payload.message_id)
+        client.cancel_message(payload.message_id, "deleted")
+
+    @client.event
+    async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+        for message_id in payload.message_ids:
+            client.history_mirror.delete(payload.channel_id, message_id)
+            client.cancel_message(message_id, "deleted")
 
     ########################
     # Moderation  Commands #
@@ -210,6 +719,8 @@ def main(args: argparse.Namespace, chatbot: ChatBotModel):
     @discord.app_commands.checks.has_role(REQUIRED_ROLE_NAME)
     async def purge_channel(interaction: discord.Interaction):
         deleted = await interaction.channel.purge(limit=100)
+        if client.summaries:
+            client.summaries.forget(interaction.channel.id)
         await interaction.response.send_message(f"Deleted len{deleted} message(s).")
 
     @client.tree.command(name="reset_channel", description="Delete and remake current channel")
@@ -249,14 +760,40 @@ def main(args: argparse.Namespace, chatbot: ChatBotModel):
                 return
 
         client.chatbot.params[f"{param}"] = value
+        client.chatbot.invalidate_prefix_cache()
+        client.response_cache.clear()
         await interaction.response.send_message(f'Parameter {param} updated to: {value}', ephemeral=True)
 
-    @client.tree.command(name="updatecharacter", description="Change character persona json reference")
+    @client.tree.command(name="updatecharacter", description="Change the character persona of this server, this channel or everyone")
     @discord.app_commands.checks.has_role(REQUIRED_ROLE_NAME)
-    async def updatecharacter(interaction: discord.Interaction, character: str):
-        client.chatbot.load_persona(character)
-        await interaction.guild.me.edit(nick=client.chatbot.character_name)
-        await interaction.response.send_message(f'Character swapped to {character}', ephemeral=True)
+    async def updatecharacter(interaction: discord.Interaction, character: str,
+                              scope: Literal["guild", "channel", "everyone"] = "guild"):
+        try:
+            if scope == "everyone":
+                # The default persona, used wherever no guild or channel binding applies
+                client.chatbot.load_persona(character)
+            else:
+                client.personas.bind(scope, interaction.channel.id if scope == "channel" else interaction.guild.id, character)
+        except (OSError, ValueError) as e:
+            await interaction.response.send_message(f'Could not load character {character}: {e}', ephemeral=True)
+            return
+        await interaction.guild.me.edit(nick=client.personas.persona(interaction.guild.id).char_name)
+        await interaction.response.send_message(f'Character for this {scope} swapped to {character}', ephemeral=True)
+
+    @client.tree.command(name="unbindcharacter", description="Return this server or channel to the default character persona")
+    @discord.app_commands.checks.has_role(REQUIRED_ROLE_NAME)
+    async def unbindcharacter(interaction: discord.Interaction, scope: Literal["guild", "channel"] = "guild"):
+        if not client.personas.unbind(scope, interaction.channel.id if scope == "channel" else interaction.guild.id):
+            await interaction.response.send_message(f'This {scope} has no character binding', ephemeral=True)
+            return
+        await interaction.guild.me.edit(nick=client.personas.persona(interaction.guild.id).char_name)
+        await interaction.response.send_message(f'This {scope} uses the default character again', ephemeral=True)
+
+    @client.tree.command(name="flushcache", description="Drop every cached instruct command reply")
+    @discord.app_commands.checks.has_role(REQUIRED_ROLE_NAME)
+    async def flushcache(interaction: discord.Interaction):
+        flushed = client.response_cache.clear()
+        await interaction.response.send_message(f'Response cache flushed, {flushed} cached replies dropped', ephemeral=True)
 
     @client.tree.command(name="printparam", description="Print current params")
     @discord.app_commands.checks.has_role(REQUIRED_ROLE_NAME)
@@ -275,7 +812,7 @@ def main(args: argparse.Namespace, chatbot: ChatBotModel):
         await interaction.response.defer()
         persona = "casual"
         prompt = chatbot.generate_instruct(persona, instruct)
-        await client.queue.put((interaction, prompt, instruct))
+        await client.submit_instruct(interaction, prompt, instruct)
 
     @client.tree.command(name="conversation_starter", description="Generate a conversation starter based on a given topic")
     async def conversation_starter(interaction: discord.Interaction, topic: str):
@@ -285,7 +822,7 @@ def main(args: argparse.Namespace, chatbot: ChatBotModel):
         await interaction.response.defer()
         persona = "casual"
         prompt = chatbot.generate_instruct(persona, instruct)
-        await client.queue.put((interaction, prompt, instruct))
+        await client.submit_instruct(interaction, prompt, instruct)
 
     @client.tree.command(name="inspirational_quote", description="Generate an inspirational quote")
     async def inspirational_quote(interaction: discord.Interaction):
@@ -295,7 +832,7 @@ def main(args: argparse.Namespace, chatbot: ChatBotModel):
         await interaction.response.defer()
         persona = "storyteller"
         prompt = chatbot.generate_instruct(persona, instruct)
-        await client.queue.put((interaction, prompt, instruct))
+        await client.submit_instruct(interaction, prompt, instruct)
 
     @client.tree.command(name="random_fact", description="Generate a random fact")
     async def random_fact(interaction: discord.Interaction):
@@ -304,7 +841,7 @@ def main(args: argparse.Namespace, chatbot: ChatBotModel):
         await interaction.response.defer()
         persona = "sme"
         prompt = chatbot.generate_instruct(persona, instruct)
-        await client.queue.put((interaction, prompt, instruct))
+        await client.submit_instruct(interaction, prompt, instruct)
 
     @client.tree.command(name="rhyme", description="Generate a list of words that rhyme with a given word")
     async def rhyme(interaction: discord.Interaction, word: str):
@@ -313,7 +850,7 @@ def main(args: argparse.Namespace, chatbot: ChatBotModel):
         await interaction.response.defer()
         persona = "professional"
         prompt = chatbot.generate_instruct(persona, instruct)
-        await client.queue.put((interaction, prompt, instruct))
+        await client.submit_instruct(interaction, prompt, instruct)
 
 
     @client.tree.command(name="instruct", description="Provide persona and instruction")
@@ -321,9 +858,19 @@ def main(args: argparse.Namespace, chatbot: ChatBotModel):
         # Acknowledge the interaction
         await interaction.response.defer()
         prompt = chatbot.generate_instruct(persona, instruct)
-        await client.queue.put((interaction, prompt, instruct))
+        await client.submit_instruct(interaction, prompt, instruct)
+
+    return client
+
 
-    # Start client
+def main(args: argparse.Namespace, chatbot: ChatBotModel):
+    """
+    The main function to start the Discord bot and handle events.
+    """
+    client = build_client(args, chatbot)
+
+    # Start client; the model keeps loading in the background while the gateway connects
+    startup_timer.start("gateway connect")
     client.run(key)
 
 if __name__ == '__main__':
@@ -333,13 +880,65 @@ if __name__ == '__main__':
     parser.add_argument("-c", "--character", type=str, default = "default_character", 
                         help="Input character json filename  within character subdirectory")
     parser.add_argument("-p", "--params", type=str, default = "default_params")
+    parser.add_argument("-b", "--backend", type=str, default="local", choices=["local", "remote", "replicas", "fake"],
+                        help="Generate in-process (local), through an inference worker (remote), across several workers (replicas), or with canned replies (fake)")
+    parser.add_argument("-wa", "--worker_address", type=str, default="unix:/tmp/llm_worker.sock",
+                        help="Inference worker address for the remote backend, unix:/path or host:port, comma separated for replicas")
+    parser.add_argument("-r", "--replicas", default=0, type=int,
+                        help="With the replicas backend, spawn this many local inference workers instead of connecting to --worker_address")
+    parser.add_argument("-dm", "--draft_model", type=str, default=None,
+                        help="Small model within models subdirectory that drafts tokens for assisted generation, overrides draft_model in the params")
+    parser.add_argument("-pb", "--persona_bindings", type=str, default="config/persona_bindings.json",
+                        help="JSON file where /updatecharacter saves which character each guild and channel uses")
+    parser.add_argument("-mlp", "--max_loaded_personas", default=32, type=int,
+                        help="Guild and channel personas kept in memory, the least recently used is unloaded beyond this")
     parser.add_argument("-pl", "--persistent_logs", action="store_true", help="Use persistent character log")
     parser.add_argument("-hl", "--history_limit", default=10, type=int, help="How many messages of history to use as context")
     parser.add_argument("-pdc", "--permanent_dialogue_context", action="store_true", help="Make character dialogue examples permanent context")
+    parser.add_argument("-ml", "--memory_limit", default=None, type=int, help="Maximum memories kept per location, oldest evicted first")
+    parser.add_argument("-rm", "--recall_memories", default=0, type=int,
+                        help="Older memories recalled into each prompt by similarity to the message, 0 disables recall")
+    parser.add_argument("-sa", "--summarize_after", default=0, type=int,
+                        help="Keep this many recent messages verbatim and fold older ones into a rolling channel summary, 0 disables")
+    parser.add_argument("-ab", "--adaptive_budget", action="store_true",
+                        help="Shrink chat context, history and reply length as queue depth and latency rise")
+    parser.add_argument("-slo", "--latency_slo", default=15.0, type=float,
+                        help="With --adaptive_budget, p95 end to end chat latency target in seconds")
+    parser.add_argument("-mct", "--min_context_tokens", default=1024, type=int, help="With --adaptive_budget, prompt token floor")
+    parser.add_argument("-mnt", "--min_new_tokens", default=64, type=int, help="With --adaptive_budget, max_new_tokens floor for chat")
+    parser.add_argument("-mhl", "--min_history_limit", default=3, type=int, help="With --adaptive_budget, history depth floor")
+    parser.add_argument("-bs", "--batch_size", default=4, type=int, help="Maximum number of queued prompts to generate in one batch")
+    parser.add_argument("-s", "--stream", action="store_true", help="Stream replies by editing a placeholder message as text is generated")
+    parser.add_argument("-ntc", "--no_token_cache", action="store_true", help="Disable the prompt segment token cache (for A/B timing)")
+    parser.add_argument("-mq", "--max_queue", default=32, type=int,
+                        help="Queued requests per replica before new ones get a busy reply")
+    parser.add_argument("-muq", "--max_user_queue", default=3, type=int,
+                        help="Queued requests per user before their new ones get a busy reply")
+    parser.add_argument("-rt", "--request_timeout", default=300, type=float,
+                        help="Seconds after which a queued or generating chat reply is abandoned, 0 disables")
+    parser.add_argument("-rct", "--response_cache_ttl", default=3600, type=float,
+                        help="Seconds instruct command replies stay cached, 0 disables the response cache")
+    parser.add_argument("-rps", "--response_pool_size", default=4, type=int,
+                        help="Pre-generated replies kept per instruct prompt when sampling")
+    parser.add_argument("-mp", "--metrics_port", default=None, type=int, help="Serve Prometheus metrics on this port at /metrics")
+    parser.add_argument("-ll", "--log_level", default="info", choices=["debug", "info", "warning", "error"],
+                        help="Logging level, debug includes full prompts and responses")
     args = parser.parse_args()
+    startup_timer.record("bot imports", time.time() - IMPORT_START)
+    logging.basicConfig(level=args.log_level.upper(), format="%(message)s")
     print(f'model: {args.model_name}, character: {args.character}, params: {args.params}')
 
-    character_persona = CharacterPersona(args.character, args.permanent_dialogue_context, args.persistent_logs)
+    load_config()
+
+    token_count_cache.enabled = not args.no_token_cache
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    character_persona = CharacterPersona(args.character, args.permanent_dialogue_context, args.persistent_logs, args.memory_limit,
+                                         args.recall_memories)
 
-    chatbot = ChatBotModel(args.model_name, character_persona, args.params, args.history_limit)
+    chatbot = ChatBotModel(args.model_name, character_persona, args.params, args.history_limit,
+                           backend=args.backend, worker_address=args.worker_address, replicas=args.replicas,
+                           draft_model=args.draft_model)
+    chatbot.start_loading()
     main(args, chatbot)
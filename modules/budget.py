@@ -0,0 +1,102 @@
+import logging, time
+from collections import deque
+
+logger = logging.getLogger("llm_discordbot.budget")
+
+class BudgetController(object):
+    """
+    Scales the prompt token budget, history depth and max_new_tokens for chat replies between
+    their floors and ceilings as load changes. Pressure is the larger of queue depth over
+    queue_target and the p95 of latencies from the last max_age seconds over the latency SLO.
+    Above 1 the level drops by a quarter, below 0.5 it recovers by a tenth per interval since
+    the last decision (so it is restored after an idle spell), and in between it holds.
+    Decisions are rate limited to one per interval seconds and every change is logged.
+    """
+    def __init__(self, min_max_tokens=1024, min_new_tokens=64, min_history_limit=3,
+                 latency_slo=15.0, queue_target=8, interval=2.0, window=50, max_age=60.0):
+        self.floors = {"max_tokens": min_max_tokens, "new_tokens": min_new_tokens, "history_limit": min_history_limit}
+        # The configured values, see set_ceilings
+        self.ceilings = {"max_tokens": 2000, "new_tokens": 300, "history_limit": 10}
+        self.latency_slo = latency_slo
+        self.queue_target = queue_target
+        self.interval = interval
+        self.max_age = max_age
+        # (time, seconds) of recent chat requests
+        self.latencies = deque(maxlen=window)
+        self.level = 1.0
+        self.last_update = 0.0
+        self.decisions = 0
+
+    def scale(self, name):
+        ceiling = self.ceilings[name]
+        floor = min(self.floors[name], ceiling)
+        return int(round(floor + self.level * (ceiling - floor)))
+
+    @property
+    def max_tokens(self):
+        return self.scale("max_tokens")
+
+    @property
+    def new_tokens(self):
+        return self.scale("new_tokens")
+
+    @property
+    def history_limit(self):
+        return self.scale("history_limit")
+
+    def set_ceilings(self, max_tokens, new_tokens, history_limit):
+        """
+        Budgets at level 1, the bot's configured values; these follow /setlimit and /updateparam.
+        """
+        self.ceilings = {"max_tokens": max_tokens, "new_tokens": new_tokens, "history_limit": history_limit}
+
+    def observe(self, latency):
+        """
+        Record a chat request's end to end latency in seconds.
+        """
+        self.latencies.append((time.time(), latency))
+
+    def latency_p95(self, now=None):
+        now = now or time.time()
+        while self.latencies and now - self.latencies[0][0] > self.max_age:
+            self.latencies.popleft()
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(latency for _, latency in self.latencies)
+        return latencies[min(len(latencies) - 1, int(round(0.95 * (len(latencies) - 1))))]
+
+    def update(self, queue_depth, now=None):
+        """
+        Adjust the level from the current queue depth and recent latencies.
+        """
+        now = now or time.time()
+        elapsed = now - self.last_update
+        if elapsed < self.interval:
+            return
+        self.last_update = now
+
+        latency = self.latency_p95(now)
+        pressure = max(queue_depth / self.queue_target, latency / self.latency_slo)
+        if pressure > 1:
+            level = self.level * 0.75
+            # Below a few percent the budgets are at their floors anyway
+            level = 0.0 if level < 0.05 else level
+        elif pressure < 0.5:
+            level = min(self.level + 0.1 * elapsed / self.interval, 1.0)
+        else:
+            return
+        if level == self.level:
+            return
+
+        before = (self.max_tokens, self.history_limit, self.new_tokens)
+        self.level = level
+        self.decisions += 1
+        logger.info("budget: queue depth %d, p95 latency %.2fs (SLO %.2fs), pressure %.2f -> level %.2f, "
+                    "context tokens %d -> %d, history %d -> %d, new tokens %d -> %d",
+                    queue_depth, latency, self.latency_slo, pressure, level,
+                    before[0], self.max_tokens, before[1], self.history_limit, before[2], self.new_tokens)
+
+    def report(self):
+        return (f"level {self.level:.2f}, context {self.max_tokens} tokens, history {self.history_limit} messages, "
+                f"{self.new_tokens} new tokens, p95 latency {self.latency_p95():.2f}s (SLO {self.latency_slo:.2f}s), "
+                f"{self.decisions} decisions")
@@ -1,16 +1,21 @@
 from modules.utils import load_json
-from modules.text_utils import replace_name_tokens
-import os, json
-from collections import defaultdict
+from modules.text_utils import replace_name_tokens, count_tokens
+from modules.chat_log import ChatLog, import_json_log
+from modules.memory_store import memory_id
+import os, threading, atexit
 from datetime import datetime
 
+# Chat logs and memory indexes are kept here; benchmarks point it at a temporary directory
+LOG_DIR = 'logs'
+
 class Persona(object):
     """
     Abstract class for Personas.
     """
 
 class CharacterPersona(Persona):
-    def __init__(self, persona_name: str, permanent_dialogue_context, persistent_logs):
+    def __init__(self, persona_name: str, permanent_dialogue_context, persistent_logs, memory_limit=None, recall_memories=0,
+                 log_tag=None):
         # Character qualities
         self.char_name = None
         self.char_persona = None
@@ -18,6 +23,11 @@ class CharacterPersona(Persona):
         self.example_dialogue = None
         self.char_greeting = None
         self.persistent_logs = persistent_logs
+        self.memory_limit = memory_limit
+        # Older memories recalled into each prompt by similarity to the current message
+        self.recall_memories = recall_memories
+        # Added to log file names so each guild or channel binding of a character keeps its own log
+        self.log_tag = log_tag
 
         # Character settings
         self.permanent_dialogue_context = permanent_dialogue_context
@@ -25,6 +35,14 @@ class CharacterPersona(Persona):
         # Interacting user settings
         self.user_name = "You"
 
+        # Rendered persona strings and token counts per (char_name, user_name)
+        self._tokenizer = None
+        self._render_cache = {}
+
+        # Append-only log backing chat_history, and the similarity index over it
+        self._chat_log = None
+        self._memory_index = None
+
         # Initialization
         self.load_persona(persona_name)
 
@@ -85,32 +103,129 @@ class CharacterPersona(Persona):
         self.char_greeting = char_greeting
         self.example_dialogue = example_dialogue
 
+        self.invalidate_render_cache()
+        self.render()
         self.setup_memories()
 
 
     def setup_memories(self):
         # Memories
-        self.chat_history = defaultdict(list)
+        if self._chat_log:
+            self._chat_log.close()
 
+        log_name = self.char_name + "_" + self.log_tag if self.log_tag else self.char_name
         if self.persistent_logs:
-            self.log_path = os.path.join('logs', self.char_name+"_"+"persistent"+".json")
-            if os.path.exists(self.log_path):
-                print("\n|| Existing logs found... loading ||\n")
-                logs = load_json(self.log_path)
-                self.chat_history = logs['chat_history']
-            else:
+            self.log_path = os.path.join(LOG_DIR, log_name+"_"+"persistent"+".jsonl")
+            json_log_path = os.path.join(LOG_DIR, log_name+"_"+"persistent"+".json")
+            if not os.path.exists(self.log_path) and os.path.exists(json_log_path):
+                import_json_log(json_log_path, self.log_path)
+            elif not os.path.exists(self.log_path):
                 print("\n|| No log found, new log will be generated ||\n")
         else:
-            self.log_path = os.path.join('logs', self.char_name+"_"+datetime.now().strftime("%m%d%H%M%S")+".json")
+            self.log_path = os.path.join(LOG_DIR, log_name+"_"+datetime.now().strftime("%m%d%H%M%S")+".jsonl")
 
+        # Existing memories load on the log thread; chat_history waits for them on first use
+        self._chat_log = ChatLog(self.log_path, self.log_header(), snapshot=lambda: self.chat_history.snapshot(),
+                                 max_size=self.memory_limit)
 
-    def generate_context(self, char_name=None, user_name=None):
-        
+        if self.recall_memories:
+            self.setup_memory_index()
+
+
+    def setup_memory_index(self):
+        # numpy is only needed when recall is on
+        from modules.memory_index import MemoryIndex
+
+        index_path = os.path.splitext(self.log_path)[0] + ".index.npz" if self.persistent_logs else None
+        self._memory_index = MemoryIndex(index_path)
+        atexit.register(self._memory_index.save)
+        threading.Thread(target=self.sync_memory_index, args=(self._memory_index,),
+                         name="memory-index-sync", daemon=True).start()
+
+
+    def sync_memory_index(self, memory_index):
+        """
+        Bring a loaded or new index in line with the log: drop evicted memories and embed missing ones.
+        """
+        chat_history = self.chat_history
+        snapshot = chat_history.snapshot()
+        memory_index.retain({memory.id for memories in snapshot.values() for memory in memories})
+        added = sum(memory_index.add(memories) for memories in snapshot.values())
+        if added:
+            memory_index.save()
+        print(f"\n|| Memory index ready: {len(memory_index)} memories, {added} newly embedded ||\n")
+
+
+    @property
+    def chat_history(self):
+        return self._chat_log.wait_loaded()
+
+
+    def log_header(self):
+        header = {key: value for key, value in self.__dict__.items() if not key.startswith('_')}
+        header["type"] = "persona"
+        return header
+
+
+    def set_tokenizer(self, tokenizer):
+        """
+        Set the tokenizer used to precompute token counts of rendered persona text.
+        """
+        self._tokenizer = tokenizer
+        self.invalidate_render_cache()
+        self.render()
+
+
+    def invalidate_render_cache(self):
+        self._render_cache = {}
+
+
+    def render(self, char_name=None, user_name=None):
+        """
+        Return the rendered context, example dialogue and greeting (and their token
+        counts) for the given names, rendering them only on first use.
+        """
         if not char_name:
             char_name = self.char_name
         if not user_name:
             user_name = self.user_name
 
+        key = (char_name, user_name)
+        if key not in self._render_cache:
+            context = self.render_context(char_name, user_name)
+            example_dialogue = self.render_example_dialogue('\n', char_name, user_name)
+            greeting = self.render_greeting(': ', char_name, user_name)
+
+            rendered = {"context": context,
+                        "example_dialogue": example_dialogue,
+                        "greeting": greeting}
+            if self._tokenizer is not None:
+                # Counted as the prompt segments they become, each following a newline
+                for name, text in list(rendered.items()):
+                    rendered[name + "_tokens"] = count_tokens(self._tokenizer, "\n" + text) if text else 0
+            self._render_cache[key] = rendered
+
+        return self._render_cache[key]
+
+
+    def generate_context(self, char_name=None, user_name=None):
+        return self.render(char_name, user_name)["context"]
+
+
+    def generate_example_dialogue(self, delim='\n', char_name=None, user_name=None):
+        if delim != '\n':
+            return self.render_example_dialogue(delim, char_name or self.char_name, user_name or self.user_name)
+        return self.render(char_name, user_name)["example_dialogue"]
+
+
+    def generate_greeting(self, delim=': ', char_name=None, user_name=None):
+        if delim != ': ':
+            return self.render_greeting(delim, char_name or self.char_name, user_name or self.user_name)
+        return self.render(char_name, user_name)["greeting"]
+
+
+    def render_context(self, char_name, user_name):
+
         permanent_context = ""
 
         if self.char_persona:
@@ -121,7 +236,7 @@ class CharacterPersona(Persona):
         permanent_context = f"{permanent_context}\n<START>\n"
 
         if self.example_dialogue and self.permanent_dialogue_context:
-            example_dialogue = self.generate_example_dialogue()
+            example_dialogue = self.render_example_dialogue('\n', self.char_name, self.user_name)
             permanent_context += f"{example_dialogue}"
 
         permanent_context = replace_name_tokens(permanent_context, char_name, user_name)
@@ -129,12 +244,8 @@ class CharacterPersona(Persona):
         return permanent_context
 
 
-    def generate_example_dialogue(self, delim='\n', char_name=None, user_name=None):
+    def render_example_dialogue(self, delim, char_name, user_name):
         example_dialogue = self.example_dialogue
-        if not char_name:
-            char_name = self.char_name
-        if not user_name:
-            user_name = self.user_name
 
         if example_dialogue:
             if type(example_dialogue) == list:
@@ -144,14 +255,9 @@ class CharacterPersona(Persona):
         return example_dialogue
 
 
-    def generate_greeting(self, delim=': ', char_name=None, user_name=None):
+    def render_greeting(self, delim, char_name, user_name):
         char_greeting = self.char_greeting
 
-        if not char_name:
-            char_name = self.char_name
-        if not user_name:
-            user_name = self.user_name
-
         if char_greeting:
             char_greeting = replace_name_tokens(char_greeting, char_name, user_name)
 
@@ -160,24 +266,59 @@ class CharacterPersona(Persona):
 
         return char_greeting
 
-    def save_logs(self, log_path):
-        with open(log_path, 'w') as f:
-            json.dump(self.__dict__, f, sort_keys=False, indent=4)
+    def close(self):
+        """
+        Write out and close the log and memory index, e.g. when the persona is unloaded.
+        """
+        if self._memory_index is not None:
+            atexit.unregister(self._memory_index.save)
+            self._memory_index.save()
+        self._chat_log.close()
+
+
+    def save_logs(self):
+        """
+        Block until every memory added so far is written to the log.
+        """
+        self._chat_log.flush()
 
 
     def load_logs(self, log_name):
         """current not used"""
-        log_dict = load_json(os.path.join('logs', log_name))
+        log_dict = load_json(os.path.join(LOG_DIR, log_name))
         for key, value in log_dict.items():
-            setattr(self, key, value)
+            if key != 'chat_history':
+                setattr(self, key, value)
 
 
     def add_message_to_history(self, message, location):
-        self.chat_history[location].append(': '.join(message))
+        self.add_memories([message], location)
 
 
     def add_memories(self, context_memory, location):
-        context_memory = [': '.join(message) for message in context_memory]
-        for memory in reversed(context_memory):
-            if memory not in self.chat_history[location]:
-                self.chat_history[location].append(memory)
+        history = self.chat_history[location]
+        added = []
+        for author, content in reversed(context_memory):
+            memory = history.add(author, content)
+            if memory:
+                self._chat_log.append(location, memory)
+                added.append(memory)
+        if added and self._memory_index is not None:
+            self._memory_index.add(added)
+
+
+    def recall(self, location, text, k, exclude=()):
+        """
+        Up to k stored (author, content) memories from location most similar to text, oldest first.
+        exclude holds (author, content) messages that are already in the prompt.
+        """
+        if self._memory_index is None or not k:
+            return []
+        history = self.chat_history[location]
+        exclude_ids = {memory_id(author, content) for author, content in exclude}
+        # Other locations share the index, so over-fetch and keep this location's memories
+        ids = self._memory_index.search(text, 2 * k, exclude_ids)
+        memories = [history.records[id] for id in ids if id in history][:k]
+        # Index rows are appended in insertion order
+        rows = self._memory_index.rows
+        return [(memory.author, memory.content) for memory in sorted(memories, key=lambda memory: rows.get(memory.id, 0))]
@@ -0,0 +1,202 @@
+import os, json, time, threading, queue, atexit
+from modules.utils import load_json
+from modules.memory_store import MemoryStore, LocationHistory
+
+class ChatLog(object):
+    """
+    Append-only JSONL chat log. The first line is a persona header, every following line
+    is one memory record. Existing records are loaded on a background thread at start, new
+    records are written in batches by the same thread, and the file is periodically compacted.
+    The file is only created, header first, once there is a record to write.
+    """
+    def __init__(self, log_path, header, snapshot=None, max_size=None,
+                 flush_interval=1.0, compact_every=10000, compact_ratio=1.5):
+        self.log_path = log_path
+        self.max_size = max_size
+        self.header = header
+        self.snapshot = snapshot
+        self.flush_interval = flush_interval
+        self.compact_every = compact_every
+        self.compact_ratio = compact_ratio
+
+        self.chat_history = MemoryStore(max_size)
+        self.loaded = threading.Event()
+        self.load_error = None
+        self.pending = queue.Queue()
+        self.lines_since_compact = 0
+        self.record_lines = 0
+
+        log_dir = os.path.dirname(log_path)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+
+        self.thread = threading.Thread(target=self.run, name=f"chat-log-{os.path.basename(log_path)}", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def wait_loaded(self):
+        """
+        Block until existing records are loaded and return the loaded history.
+        Raises if the log could not be read.
+        """
+        self.loaded.wait()
+        if self.load_error is not None:
+            raise RuntimeError(f"Could not load chat log {self.log_path}") from self.load_error
+        return self.chat_history
+
+    def append(self, location, memory):
+        self.pending.put(memory_record(location, memory))
+
+    def flush(self):
+        """
+        Block until every record appended so far is on disk.
+        """
+        done = threading.Event()
+        self.pending.put(done)
+        done.wait()
+
+    def close(self):
+        # Unregistered so a closed log (and the history it holds) can be freed
+        atexit.unregister(self.close)
+        if self.thread.is_alive():
+            self.pending.put(None)
+            self.thread.join()
+
+    def run(self):
+        try:
+            self.load()
+        except Exception as e:
+            # Keep draining pending so flush() waiters are released, but leave the unreadable file alone
+            self.load_error = e
+            print(f"\n|| Could not load {self.log_path}, new records will not be saved: {e!r} ||\n")
+        finally:
+            self.loaded.set()
+
+        f = None
+        closing = False
+        while not closing:
+            batch = []
+            waiters = []
+            item = self.pending.get()
+            deadline = time.time() + self.flush_interval
+            # Collect records for up to flush_interval so they go out in one write
+            while True:
+                if item is None:
+                    closing = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                timeout = 0 if (closing or waiters) else max(deadline - time.time(), 0)
+                try:
+                    item = self.pending.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+            if batch and self.load_error is None:
+                if f is None:
+                    f = open(self.log_path, 'a', encoding='utf-8')
+                    if f.tell() == 0:
+                        f.write(json.dumps(self.header) + '\n')
+                f.write(''.join(json.dumps(record) + '\n' for record in batch))
+                f.flush()
+                self.lines_since_compact += len(batch)
+                self.record_lines += len(batch)
+
+            if f is not None and self.snapshot and self.lines_since_compact >= self.compact_every:
+                self.lines_since_compact = 0
+                chat_history = self.snapshot()
+                # Only rewrite once enough of the file is superseded records
+                if self.record_lines > self.compact_ratio * sum(len(memories) for memories in chat_history.values()):
+                    f.close()
+                    self.compact(chat_history)
+                    f = open(self.log_path, 'a', encoding='utf-8')
+
+            for waiter in waiters:
+                waiter.set()
+        if f is not None:
+            f.close()
+
+    def load(self):
+        """
+        Stream records from an existing log line by line into chat_history.
+        Lines that do not parse are skipped. A broken last line, left by a crash in the middle
+        of an append, is truncated so new records do not follow it on the same line.
+        """
+        chat_history = MemoryStore(self.max_size)
+        if os.path.exists(self.log_path):
+            print(f"\n|| Existing logs found... loading {self.log_path} ||\n")
+            with open(self.log_path, 'rb') as f:
+                offset = 0
+                # Start of the last line that did not parse, if no good record followed it
+                broken = None
+                line = b''
+                for line in f:
+                    line_start, offset = offset, offset + len(line)
+                    if not line.strip():
+                        continue
+                    if broken is not None:
+                        print(f"\n|| Skipped an unreadable line at byte {broken} of {self.log_path} ||\n")
+                        broken = None
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        broken = line_start
+                        continue
+                    if record.get("type") == "memory":
+                        if "memory" in record:
+                            # Records written before memories were split into author and content
+                            author, _, content = record["memory"].partition(': ')
+                            chat_history[record["location"]].add(author, content)
+                        else:
+                            chat_history[record["location"]].add(record["author"], record["content"], record["id"])
+                        self.record_lines += 1
+
+            if broken is not None:
+                print(f"\n|| Truncated an incomplete last line at byte {broken} of {self.log_path} ||\n")
+                with open(self.log_path, 'r+b') as f:
+                    f.truncate(broken)
+            elif line and not line.endswith(b'\n'):
+                # The last record is whole but lost its newline, so the next append needs one
+                with open(self.log_path, 'ab') as f:
+                    f.write(b'\n')
+        self.chat_history = chat_history
+
+    def compact(self, chat_history):
+        """
+        Rewrite the log as the header plus one record per live memory.
+        """
+        tmp_path = self.log_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.header) + '\n')
+            for location, memories in chat_history.items():
+                for memory in memories:
+                    f.write(json.dumps(memory_record(location, memory)) + '\n')
+        os.replace(tmp_path, self.log_path)
+        self.record_lines = sum(len(memories) for memories in chat_history.values())
+        print(f"\n|| Compacted {self.log_path} to {self.record_lines} records ||\n")
+
+
+def memory_record(location, memory):
+    return {"type": "memory", "location": location, "id": memory.id, "author": memory.author, "content": memory.content}
+
+
+def import_json_log(json_path, log_path):
+    """
+    Convert a log written by the old full-JSON save_logs into the JSONL format.
+    """
+    logs = load_json(json_path)
+    chat_history = logs.pop('chat_history', {})
+    header = {key: value for key, value in logs.items() if not key.startswith('_')}
+    header["type"] = "persona"
+
+    with open(log_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(header) + '\n')
+        for location, memories in chat_history.items():
+            history = LocationHistory()
+            for memory in memories:
+                author, _, content = memory.partition(': ')
+                memory = history.add(author, content)
+                if memory:
+                    f.write(json.dumps(memory_record(location, memory)) + '\n')
+    print(f"\n|| Imported {json_path} into {log_path} ||\n")
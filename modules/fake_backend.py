@@ -0,0 +1,82 @@
+import re, time
+from modules.text_utils import trim_stop_sequences
+
+class FakeTokenizer(object):
+    """
+    Weight-free stand-in for a huggingface tokenizer: one token per word or punctuation mark.
+    """
+    name_or_path = "fake"
+    pattern = re.compile(r"\w+|[^\w\s]")
+
+    def __init__(self):
+        self.vocab = {}
+        self.words = []
+
+    def encode(self, text, **kwargs):
+        token_ids = []
+        for word in self.pattern.findall(text):
+            if word not in self.vocab:
+                self.vocab[word] = len(self.words)
+                self.words.append(word)
+            token_ids.append(self.vocab[word])
+        return token_ids
+
+    def __call__(self, texts, **kwargs):
+        if isinstance(texts, str):
+            return {"input_ids": self.encode(texts)}
+        return {"input_ids": [self.encode(text) for text in texts]}
+
+    def decode(self, token_ids, **kwargs):
+        return ' '.join(self.words[token_id] for token_id in token_ids)
+
+    def __repr__(self):
+        return f"FakeTokenizer(vocab_size={len(self.words)})"
+
+
+class FakeBackend(object):
+    """
+    Backend that returns canned replies without a model, for exercising the bot without weights.
+    Each generated token takes token_latency seconds and is streamed to text_callback.
+    """
+    reply = "This is a placeholder reply from the fake backend, no model weights were loaded."
+
+    def __init__(self, tokenizer=None, token_latency=0.0):
+        self.model_name = "fake"
+        self.tokenizer = tokenizer or FakeTokenizer()
+        self.token_latency = token_latency
+        self.requests = 0
+
+    def invalidate_prefix_cache(self):
+        pass
+
+    def health(self):
+        return {"status": "ok", "model": self.model_name, "requests": self.requests}
+
+    def generate(self, prompts, params, prefix=None, text_callback=None, cancel_events=None):
+        start_time = time.time()
+        words = self.reply.split(' ')
+        truncated = len(words) > params.get("max_new_tokens", 300)
+        words = words[:params.get("max_new_tokens", 300)]
+        for i, word in enumerate(words):
+            if cancel_events and all(event.is_set() for event in cancel_events):
+                words = words[:i]
+                break
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            if text_callback and len(prompts) == 1:
+                text_callback(word if i == 0 else ' ' + word, i == len(words) - 1)
+
+        self.requests += len(prompts)
+        tokens_generated = len(words) * len(prompts)
+        total_time = max(time.time() - start_time, 1e-9)
+        print(f"\n||Generation speed: {total_time:.1f}s, {tokens_generated} tokens, {tokens_generated/total_time:.2f} tokens/s ||\n")
+        stats = {"tokens_generated": tokens_generated,
+                 "reply_tokens": [len(words)] * len(prompts),
+                 "prompt_tokens": [len(getattr(prompt, "input_ids", None) or self.tokenizer.encode(prompt)) for prompt in prompts],
+                 "prefill_time": 0.0,
+                 "decode_time": total_time,
+                 "total_time": total_time}
+        return [trim_stop_sequences(' '.join(words), getattr(prompt, "stop_sequences", []), truncated) for prompt in prompts], stats
+
+    def close(self):
+        pass
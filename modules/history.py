@@ -0,0 +1,92 @@
+from collections import OrderedDict
+
+class ChannelHistoryMirror(object):
+    """
+    In-memory ring buffer of recent cleaned messages per channel, kept current from gateway events.
+    Each entry maps a message id to its cleaned (display_name, clean_content) tuple.
+    """
+    def __init__(self, max_messages=100):
+        self.max_messages = max_messages
+        self.channels = {}
+        # Channels whose whole history fits in the buffer, so short buffers are still valid
+        self.complete = set()
+
+    def seed(self, channel_id, messages, complete=False):
+        """
+        Rebuild a channel buffer from a REST fetch (newest first), keeping any
+        messages that arrived over the gateway while the fetch was in flight.
+        """
+        buffer = OrderedDict((message_id, message) for message_id, message in reversed(messages))
+        newest_id = next(reversed(buffer)) if buffer else 0
+        for message_id, message in self.channels.get(channel_id, {}).items():
+            if message_id > newest_id:
+                buffer[message_id] = message
+
+        while len(buffer) > self.max_messages:
+            buffer.popitem(last=False)
+            complete = False
+
+        self.channels[channel_id] = buffer
+        if complete:
+            self.complete.add(channel_id)
+        else:
+            self.complete.discard(channel_id)
+
+    def add(self, channel_id, message_id, message):
+        buffer = self.channels.get(channel_id)
+        if buffer is None:
+            # Cold channel, wait for a REST seed before trusting the buffer
+            return
+        buffer[message_id] = message
+        if len(buffer) > self.max_messages:
+            buffer.popitem(last=False)
+            self.complete.discard(channel_id)
+
+    def edit(self, channel_id, message_id, message):
+        buffer = self.channels.get(channel_id)
+        if buffer is not None and message_id in buffer:
+            buffer[message_id] = message
+
+    def delete(self, channel_id, message_id):
+        buffer = self.channels.get(channel_id)
+        if buffer is not None:
+            buffer.pop(message_id, None)
+
+    def get(self, channel_id, message_id):
+        buffer = self.channels.get(channel_id)
+        if buffer is None:
+            return None
+        return buffer.get(message_id)
+
+    def contains(self, channel_id, message_id):
+        buffer = self.channels.get(channel_id)
+        return buffer is not None and message_id in buffer
+
+    def history(self, channel_id, limit):
+        """
+        Return up to limit (message_id, message) pairs, newest first, or None
+        if the buffer is cold or cannot cover the limit.
+        """
+        buffer = self.channels.get(channel_id)
+        if buffer is None or limit > self.max_messages:
+            return None
+        if len(buffer) < limit and channel_id not in self.complete:
+            return None
+
+        history = []
+        for message_id in reversed(buffer):
+            if len(history) >= limit:
+                break
+            history.append((message_id, buffer[message_id]))
+        return history
+
+    def invalidate(self, channel_id=None):
+        """
+        Drop one channel buffer, or all of them after a gap in gateway events.
+        """
+        if channel_id is None:
+            self.channels.clear()
+            self.complete.clear()
+        else:
+            self.channels.pop(channel_id, None)
+            self.complete.discard(channel_id)
@@ -0,0 +1,140 @@
+"""
+Long-lived inference worker. Loads the model once and serves generation requests from the
+bot over a Unix socket or localhost TCP, so the bot can restart without reloading weights.
+
+    python -m modules.inference_worker -m <model_name> -a unix:/tmp/llm_worker.sock
+    python -m modules.inference_worker --fake -a 127.0.0.1:5005
+    python -m modules.inference_worker -m <model_name> -a unix:/tmp/llm_worker_1.sock -d cuda:1
+
+Protocol: one JSON object per line in each direction. Requests carry an "id" and a "method"
+(generate, cancel, health or invalidate); replies echo the id. Streamed text arrives as {"id", "text"}
+messages before the final reply. Requests on one connection may be pipelined; generations run
+one at a time in arrival order while health checks and cancels are answered immediately.
+{"method": "cancel", "target": <generate id>, "index": i} stops prompt i of that generation early.
+"""
+import asyncio, argparse, json, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from modules.fake_backend import FakeBackend
+from modules.remote_backend import parse_address
+from modules.text_utils import TokenPrompt
+
+class InferenceWorker(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.start_time = time.time()
+        self.requests = 0
+        self.queued = 0
+        # (connection, generate id) -> one cancel event per prompt
+        self.cancel_events = {}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        tasks = set()
+
+        def send(message):
+            # Only ever called on the event loop thread, so lines never interleave
+            if not writer.is_closing():
+                writer.write((json.dumps(message) + '\n').encode('utf-8'))
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.create_task(self.handle_request(json.loads(line), send, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, ValueError) as e:
+            print(f"\n|| Connection dropped: {e!r} ||\n")
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def handle_request(self, request, send, writer):
+        message_id = request.get("id")
+        method = request.get("method")
+        try:
+            if method == "health":
+                send({"id": message_id,
+                      "status": "ok",
+                      "model": self.backend.model_name,
+                      "uptime": time.time() - self.start_time,
+                      "requests": self.requests,
+                      "queued": self.queued})
+            elif method == "invalidate":
+                self.backend.invalidate_prefix_cache()
+                send({"id": message_id, "status": "ok"})
+            elif method == "cancel":
+                events = self.cancel_events.get((id(writer), request["target"]))
+                if events and 0 <= request["index"] < len(events):
+                    events[request["index"]].set()
+                send({"id": message_id, "status": "ok"})
+            elif method == "generate":
+                responses, stats = await self.generate(request, send, writer)
+                send({"id": message_id, "responses": responses, "stats": stats})
+            else:
+                send({"id": message_id, "error": f"unknown method {method}"})
+        except Exception as e:
+            send({"id": message_id, "error": repr(e)})
+        await writer.drain()
+
+    async def generate(self, request, send, writer):
+        loop = asyncio.get_running_loop()
+        message_id = request["id"]
+
+        def stream_text(text, stream_end):
+            loop.call_soon_threadsafe(send, {"id": message_id, "text": text})
+        text_callback = stream_text if request.get("stream") else None
+
+        key = (id(writer), message_id)
+        cancel_events = self.cancel_events[key] = [threading.Event() for _ in request["prompts"]]
+        self.queued += 1
+        try:
+            result = await loop.run_in_executor(self.executor, self.backend.generate,
+                                                [TokenPrompt.from_json(prompt) if isinstance(prompt, dict) else prompt
+                                                 for prompt in request["prompts"]],
+                                                request["params"],
+                                                request.get("prefix"), text_callback, cancel_events)
+        finally:
+            self.queued -= 1
+            self.cancel_events.pop(key, None)
+        self.requests += 1
+        return result
+
+    async def serve(self, address):
+        family, bind_address = parse_address(address)
+        if isinstance(bind_address, str):
+            if os.path.exists(bind_address):
+                os.remove(bind_address)
+            server = await asyncio.start_unix_server(self.handle_connection, path=bind_address)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=bind_address[0], port=bind_address[1])
+        print(f"\n|| Inference worker serving {self.backend.model_name} on {address} ||\n")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model_name", type=str, default=None,
+                        help="Input foldername of model within models subdirectory")
+    parser.add_argument("-a", "--address", type=str, default="unix:/tmp/llm_worker.sock",
+                        help="unix:/path/to/socket or host:port to listen on")
+    parser.add_argument("-d", "--device", type=str, default="auto",
+                        help="Device map for the model: auto, a single device like cuda:1, or cpu")
+    parser.add_argument("-dm", "--draft_model", type=str, default=None,
+                        help="Small model within models subdirectory that drafts tokens for assisted generation")
+    parser.add_argument("--fake", action="store_true", help="Serve canned replies without loading a model")
+    parser.add_argument("--token_latency", type=float, default=0.0, help="Seconds per generated token for the fake backend")
+    args = parser.parse_args()
+
+    if args.fake:
+        backend = FakeBackend(token_latency=args.token_latency)
+    else:
+        from modules.models import load_tokenizer
+        from modules.transformers_backend import TransformersBackend
+        backend = TransformersBackend(os.path.join('models', args.model_name), load_tokenizer(args.model_name), args.device,
+                                      os.path.join('models', args.draft_model) if args.draft_model else None)
+
+    asyncio.run(InferenceWorker(backend).serve(args.address))
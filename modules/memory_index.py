@@ -0,0 +1,142 @@
+import os, re, threading, zlib
+import numpy as np
+
+word_pattern = re.compile(r"\w+")
+
+def hashed_features(texts, dim=256):
+    """
+    L2-normalized signed hashed bag of lowercase words and word bigrams, one float32 row per text.
+    Hashing with crc32 keeps rows stable across processes, so saved rows stay valid.
+    """
+    rows, cols, values = [], [], []
+    for row, text in enumerate(texts):
+        words = word_pattern.findall(text.lower())
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            h = zlib.crc32(feature.encode('utf-8'))
+            rows.append(row)
+            cols.append(h % dim)
+            values.append(1.0 if h & 0x80000000 else -1.0)
+
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    np.add.at(vectors, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)), np.array(values, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-9)
+
+
+def memory_text(memory):
+    return f"{memory.author} {memory.content}"
+
+
+class MemoryIndex(object):
+    """
+    Append-only matrix of hashed feature vectors for memories, searched by dot product.
+    Queries are weighted by inverse document frequency per feature bucket so common words
+    count for less. Rows are keyed by memory id and can be saved to and loaded from an .npz file.
+    """
+    def __init__(self, path=None, dim=256):
+        self.path = path
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.ids = []
+        self.rows = {}
+        self.vectors = np.zeros((1024, dim), dtype=np.float32)
+        self.document_frequency = np.zeros(dim, dtype=np.float64)
+
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self.rows
+
+    def load(self):
+        data = np.load(self.path)
+        if data["vectors"].shape[1] != self.dim:
+            print(f"\n|| Memory index {self.path} has dimension {data['vectors'].shape[1]}, rebuilding ||\n")
+            return
+        self.ids = [int(id) for id in data["ids"]]
+        self.rows = {id: row for row, id in enumerate(self.ids)}
+        self.vectors = np.array(data["vectors"], dtype=np.float32)
+        self.document_frequency = np.array(data["document_frequency"], dtype=np.float64)
+        print(f"\n|| Loaded memory index {self.path} with {len(self.ids)} memories ||\n")
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            ids = np.array(self.ids, dtype=np.uint64)
+            vectors = self.vectors[:len(self.ids)].copy()
+            document_frequency = self.document_frequency.copy()
+        tmp_path = self.path + '.tmp.npz'
+        np.savez(tmp_path, ids=ids, vectors=vectors, document_frequency=document_frequency)
+        os.replace(tmp_path, self.path)
+
+    def add(self, memories):
+        """
+        Embed and append the memories that are not indexed yet. Returns how many were added.
+        """
+        memories = list({memory.id: memory for memory in memories if memory.id not in self.rows}.values())
+        if not memories:
+            return 0
+        vectors = hashed_features([memory_text(memory) for memory in memories], self.dim)
+
+        with self.lock:
+            # Another thread may have indexed some of them meanwhile
+            keep = [i for i, memory in enumerate(memories) if memory.id not in self.rows]
+            memories = [memories[i] for i in keep]
+            vectors = vectors[keep]
+            start = len(self.ids)
+            end = start + len(memories)
+            if end > len(self.vectors):
+                # Double the capacity so appends stay amortized O(1)
+                grown = np.zeros((max(end, 2 * len(self.vectors)), self.dim), dtype=np.float32)
+                grown[:start] = self.vectors[:start]
+                self.vectors = grown
+            self.vectors[start:end] = vectors
+            self.document_frequency += (vectors != 0).sum(axis=0)
+            for row, memory in enumerate(memories, start):
+                self.rows[memory.id] = row
+                self.ids.append(memory.id)
+        return len(memories)
+
+    def retain(self, live_ids):
+        """
+        Drop rows whose memory is no longer stored, e.g. after memory_limit evictions.
+        """
+        with self.lock:
+            keep = [row for row, id in enumerate(self.ids) if id in live_ids]
+            if len(keep) == len(self.ids):
+                return
+            self.vectors = self.vectors[keep]
+            self.ids = [self.ids[row] for row in keep]
+            self.rows = {id: row for row, id in enumerate(self.ids)}
+            self.document_frequency = (self.vectors != 0).sum(axis=0).astype(np.float64)
+
+    def search(self, text, k, exclude=(), min_score=0.1):
+        """
+        Up to k memory ids most similar to text, best first, skipping ids in exclude.
+        """
+        with self.lock:
+            count = len(self.ids)
+            if not count or k <= 0:
+                return []
+            idf = np.log((count + 1) / (self.document_frequency + 1)) + 1
+            query = hashed_features([text], self.dim)[0] * idf
+            scores = self.vectors[:count] @ query.astype(np.float32)
+            ids = self.ids
+
+        # Over-fetch so excluded memories do not leave the result short
+        top = min(k + len(exclude), count)
+        candidates = np.argpartition(-scores, top - 1)[:top]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        results = []
+        for row in candidates:
+            if scores[row] < min_score:
+                break
+            if ids[row] not in exclude:
+                results.append(ids[row])
+                if len(results) >= k:
+                    break
+        return results
@@ -0,0 +1,84 @@
+import hashlib
+from collections import OrderedDict, namedtuple
+
+Memory = namedtuple('Memory', ['id', 'author', 'content'])
+
+def memory_id(author, content):
+    """
+    Stable 64-bit id for a memory, derived from its author and content.
+    """
+    digest = hashlib.blake2b(f"{author}\x00{content}".encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class LocationHistory(object):
+    """
+    Insertion-ordered memories for one location with O(1) dedupe by id.
+    When max_size is set the oldest memories are evicted first.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.records = OrderedDict()
+        self.evicted = 0
+
+    def add(self, author, content, id=None):
+        """
+        Add a memory unless one with the same id is already stored. Returns the new Memory or None.
+        """
+        if id is None:
+            id = memory_id(author, content)
+        if id in self.records:
+            return None
+
+        memory = Memory(id, author, content)
+        self.records[id] = memory
+        if self.max_size and len(self.records) > self.max_size:
+            self.records.popitem(last=False)
+            self.evicted += 1
+        return memory
+
+    def __contains__(self, id):
+        return id in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def latest(self, n):
+        """
+        The n most recent memories, oldest first.
+        """
+        memories = []
+        for id in reversed(self.records):
+            if len(memories) >= n:
+                break
+            memories.append(self.records[id])
+        return memories[::-1]
+
+
+class MemoryStore(object):
+    """
+    Per-location LocationHistory collection, created on first access like a defaultdict.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.locations = {}
+
+    def __getitem__(self, location):
+        if location not in self.locations:
+            self.locations[location] = LocationHistory(self.max_size)
+        return self.locations[location]
+
+    def __len__(self):
+        return sum(len(history) for history in self.locations.values())
+
+    def items(self):
+        return self.locations.items()
+
+    def snapshot(self):
+        """
+        Copy of every location's memories, safe to serialize from another thread.
+        """
+        return {location: list(history.records.values()) for location, history in list(self.locations.items())}
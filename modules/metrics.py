@@ -0,0 +1,229 @@
+import threading, bisect
+from collections import deque, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Metric(object):
+    """
+    Base for metrics that can be rendered in the Prometheus text format.
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self.values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] += amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def samples(self):
+        with self.lock:
+            return [f"{self.name}{format_labels(labels)} {value}" for labels, value in self.values.items()]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [f"{self.name} {self.value}"]
+
+
+class Histogram(Metric):
+    """
+    Cumulative bucket counts for Prometheus plus a window of recent observations for percentiles.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets, window=1000):
+        super().__init__(name, help)
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+            self.recent.append(value)
+
+    def percentile(self, pct):
+        with self.lock:
+            values = sorted(self.recent)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+    def samples(self):
+        with self.lock:
+            lines = []
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+            lines.append(f"{self.name}_sum {self.sum}")
+            lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self.register(Gauge(name, help))
+
+    def histogram(self, name, help, buckets):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+TOKEN_BUCKETS = [16, 32, 64, 128, 256, 512, 1024, 1536, 2048, 4096]
+RATE_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+registry = MetricsRegistry()
+
+REQUESTS = registry.counter("llmbot_requests_total", "Generation requests enqueued, by kind")
+RESPONSE_CACHE = registry.counter("llmbot_response_cache_total", "Instruct command response cache lookups, by result")
+DROPPED = registry.counter("llmbot_dropped_total", "Requests dropped before generation, by reason")
+CANCELLED = registry.counter("llmbot_cancelled_total", "Requests cancelled during generation, by reason")
+WASTED_SECONDS = registry.counter("llmbot_wasted_generation_seconds_total",
+                                  "Generation time spent on replies that were never sent, by reason")
+SUMMARIES = registry.counter("llmbot_summary_refreshes_total", "Rolling conversation summary refreshes, by result")
+DRAFT_TOKENS = registry.counter("llmbot_draft_tokens_total", "Tokens proposed by the draft model in assisted generation, by result")
+ERRORS = registry.counter("llmbot_errors_total", "Errors, by pipeline stage")
+QUEUE_DEPTH = registry.gauge("llmbot_queue_depth", "Requests waiting for generation")
+QUEUE_WAIT = registry.histogram("llmbot_queue_wait_seconds", "Time from enqueue to start of generation", SECONDS_BUCKETS)
+BATCH_SIZE = registry.histogram("llmbot_batch_size", "Requests per generate call", [1, 2, 4, 8, 16, 32])
+PROMPT_TOKENS = registry.histogram("llmbot_prompt_tokens", "Prompt tokens per request", TOKEN_BUCKETS)
+GENERATED_TOKENS = registry.histogram("llmbot_generated_tokens", "Generated tokens per generate call", TOKEN_BUCKETS)
+REPLY_TOKENS = registry.histogram("llmbot_reply_tokens", "Generated tokens per reply", TOKEN_BUCKETS)
+STOPPED_REPLIES = registry.counter("llmbot_stop_sequence_replies_total", "Replies that ended at a stop sequence such as another speaker's turn")
+TOKENS_PER_SECOND = registry.histogram("llmbot_tokens_per_second", "Generated tokens per second per generate call", RATE_BUCKETS)
+PREFILL_SECONDS = registry.histogram("llmbot_prefill_seconds", "Time to first token per generate call", SECONDS_BUCKETS)
+DECODE_SECONDS = registry.histogram("llmbot_decode_seconds", "Time after the first token per generate call", SECONDS_BUCKETS)
+SEND_SECONDS = registry.histogram("llmbot_send_seconds", "Discord send latency per reply", SECONDS_BUCKETS)
+
+
+def record_generation(stats, batch_size):
+    """
+    Record the stats dict returned by a backend's generate call.
+    """
+    BATCH_SIZE.observe(batch_size)
+    for prompt_tokens in stats.get("prompt_tokens", []):
+        PROMPT_TOKENS.observe(prompt_tokens)
+    GENERATED_TOKENS.observe(stats.get("tokens_generated", 0))
+    for reply_tokens in stats.get("reply_tokens", []):
+        REPLY_TOKENS.observe(reply_tokens)
+    if stats.get("stopped"):
+        STOPPED_REPLIES.inc(stats["stopped"])
+    if stats.get("total_time"):
+        TOKENS_PER_SECOND.observe(stats.get("tokens_generated", 0) / stats["total_time"])
+    if "prefill_time" in stats:
+        PREFILL_SECONDS.observe(stats["prefill_time"])
+    if "decode_time" in stats:
+        DECODE_SECONDS.observe(stats["decode_time"])
+    if stats.get("draft_tokens"):
+        DRAFT_TOKENS.inc(stats["accepted_tokens"], result="accepted")
+        DRAFT_TOKENS.inc(stats["draft_tokens"] - stats["accepted_tokens"], result="rejected")
+
+
+def summary():
+    """
+    Short human readable summary for the /stats command.
+    """
+    lines = [f"Requests: {int(REQUESTS.total())}, errors: {int(ERRORS.total())}, queue depth: {int(QUEUE_DEPTH.value)}, "
+             f"response cache hits: {int(RESPONSE_CACHE.values[(('result', 'hit'),)])}, "
+             f"superseded: {int(DROPPED.values[(('reason', 'superseded'),)])}, busy: {int(DROPPED.values[(('reason', 'busy'),)])}, "
+             f"deleted: {int(DROPPED.values[(('reason', 'deleted'),)] + CANCELLED.values[(('reason', 'deleted'),)])}, "
+             f"expired: {int(DROPPED.values[(('reason', 'expired'),)] + CANCELLED.values[(('reason', 'expired'),)])}, "
+             f"wasted generation: {WASTED_SECONDS.total():.1f}s"]
+    for name, histogram, unit in (("Queue wait", QUEUE_WAIT, "s"),
+                                  ("Prefill", PREFILL_SECONDS, "s"),
+                                  ("Decode", DECODE_SECONDS, "s"),
+                                  ("Send", SEND_SECONDS, "s"),
+                                  ("Prompt tokens", PROMPT_TOKENS, ""),
+                                  ("Generated tokens", GENERATED_TOKENS, ""),
+                                  ("Reply tokens", REPLY_TOKENS, ""),
+                                  ("Tokens/s", TOKENS_PER_SECOND, "")):
+        if histogram.count:
+            lines.append(f"{name}: p50 {histogram.percentile(50):.2f}{unit}, p95 {histogram.percentile(95):.2f}{unit}, "
+                         f"avg {histogram.sum / histogram.count:.2f}{unit} over {histogram.count}")
+    if REPLY_TOKENS.count:
+        lines.append(f"Replies ended at a stop sequence: {int(STOPPED_REPLIES.total())} of {REPLY_TOKENS.count}")
+    if DRAFT_TOKENS.total():
+        accepted = DRAFT_TOKENS.values[(('result', 'accepted'),)]
+        lines.append(f"Draft acceptance: {accepted / DRAFT_TOKENS.total():.0%} of {int(DRAFT_TOKENS.total())} proposed tokens")
+    return '\n'.join(lines)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """
+    Serve /metrics in the Prometheus text format from a daemon thread.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"\n|| Metrics served on http://{host}:{port}/metrics ||\n")
+    return server
@@ -1,28 +1,66 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
-import torch, os, time
+import importlib, os, threading, time, weakref
+from concurrent.futures import Future
 from datetime import datetime
-from modules.utils import load_json, clear_cache
+from modules.utils import load_json, startup_timer
 from modules.character import CharacterPersona
-from modules.text_utils import generate_history, generate_temporary_context, fetch_instruct_preprompt
+from modules.fake_backend import FakeBackend, FakeTokenizer
+from modules.remote_backend import RemoteBackend
+from modules.replicas import ReplicaPool, spawn_workers
+from modules.metrics import record_generation
+from modules.text_utils import generate_history, generate_temporary_context, fetch_instruct_preprompt, clean_messages, encode_segments, token_count_cache, TokenPrompt, speaker_stop_sequences
+
+def load_tokenizer(model_name):
+    if model_name is None:
+        return FakeTokenizer()
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(os.path.join('models', model_name))
+
+
+def load_backend(backend, model_name, tokenizer, worker_address=None, replicas=0, draft_model=None):
+    """
+    Create the generation backend: the in-process model, a remote inference worker, a pool of
+    worker replicas (spawned here when replicas is set), or the fake backend.
+    draft_model names a small model in models/ for assisted generation; remote workers take it on their own command line.
+    """
+    if backend == "remote":
+        return RemoteBackend(worker_address)
+    elif backend == "replicas":
+        if replicas:
+            processes, addresses = spawn_workers(replicas, model_name, draft_model=draft_model)
+        else:
+            processes, addresses = [], worker_address.split(',')
+        pool = ReplicaPool(addresses, processes)
+        pool.wait_ready()
+        return pool
+    elif backend == "fake":
+        return FakeBackend(tokenizer)
+    from modules.transformers_backend import TransformersBackend
+    return TransformersBackend(os.path.join('models', model_name), tokenizer,
+                               draft_model_dir=os.path.join('models', draft_model) if draft_model else None)
+
 
 class ChatBotModel:
-    def __init__(self, model_name, character_persona, param_name, history_limit=10):
+    def __init__(self, model_name, character_persona, param_name, history_limit=10,
+                 backend="local", worker_address=None, replicas=0, draft_model=None):
 
-        model_dir = os.path.join('models', model_name)
         param_dir = os.path.join('config', param_name+'.json')
         
-        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
-        self.tokenizer.truncation_side = 'left'
-        print(f'\n|| TOKENIZER INITIALIZED: {self.tokenizer}')
+        self.model_name = model_name
+        self.backend_name = backend
+        self.worker_address = worker_address
+        self.spawn_replicas = replicas
+        self.replica_count = (replicas or len(worker_address.split(','))) if backend == "replicas" else 1
 
-        self.model = AutoModelForCausalLM.from_pretrained(
-            pretrained_model_name_or_path=model_dir,
-            load_in_8bit=True,
-            torch_dtype=torch.float16,
-            device_map="auto"
-        )
+        # Set by load(), which start_loading() runs on a background thread
+        self.tokenizer = None
+        self.backend = None
+        self.ready = Future()
 
         self.params = load_json(param_dir)
+        # The draft model is a load time setting, not a generate() argument
+        self.draft_model = draft_model or self.params.pop("draft_model", None)
+        # Extra stop strings for chat replies, on top of the speaker turns in each prompt
+        self.stop_sequences = self.params.pop("stop_sequences", [])
         print(f'|| \nPARAMS: {self.params}\n||\n')
 
         self.discord_name = ""
@@ -32,41 +70,149 @@ class ChatBotModel:
         self.character_name = character_persona.char_name
         self.max_tokens = 2000
 
+        # (rendered context, prefix text, prefix ids) per persona, dropped with the persona
+        self.prefixes = weakref.WeakKeyDictionary()
+
+
+    def start_loading(self):
+        """
+        Load the tokenizer and model on a background thread. Returns the ready future.
+        """
+        threading.Thread(target=self.load, name="model-loader", daemon=True).start()
+        return self.ready
+
+    def load(self):
+        """
+        Load the tokenizer and backend, run a warmup generation, then resolve the ready future.
+        """
+        try:
+            if self.model_name:
+                # Imported here only so their import time is reported as its own startup phase
+                with startup_timer.phase("model imports"):
+                    importlib.import_module("transformers")
+                    if self.backend_name == "local":
+                        importlib.import_module("modules.transformers_backend")
+
+            with startup_timer.phase("tokenizer"):
+                self.tokenizer = load_tokenizer(self.model_name)
+                self.character_persona.set_tokenizer(self.tokenizer)
+            print(f'\n|| TOKENIZER INITIALIZED: {self.tokenizer}')
+
+            with startup_timer.phase("weights"):
+                self.backend = load_backend(self.backend_name, self.model_name, self.tokenizer,
+                                            self.worker_address, self.spawn_replicas, self.draft_model)
+            print(f'\n|| BACKEND INITIALIZED: {self.backend_name} {self.backend.health()}')
+
+            with startup_timer.phase("warmup"):
+                self.warmup()
+        except BaseException as e:
+            self.ready.set_exception(e)
+            raise
+        self.ready.set_result(self)
+
+    def warmup(self):
+        """
+        Run one short generation on every replica so the first real request does not pay for
+        kernel setup, and build the persona prefix cache while we are at it.
+        """
+        prefix = self.generate_prefix()
+        params = dict(self.params, max_new_tokens=4)
+        for replica in self.replicas:
+            replica.generate([prefix + "\n" + self.character_name + ":"], params, prefix)
 
     def load_persona(self, character):
         self.character_persona.load_persona(character)
         self.character_name = self.character_persona.char_name
         self.log_path = self.character_persona.log_path
+        self.invalidate_prefix_cache()
+
+    def invalidate_prefix_cache(self):
+        if self.backend:
+            self.backend.invalidate_prefix_cache()
+
+    @property
+    def replicas(self):
+        """
+        Backends that can generate independently, one unless the backend is a replica pool.
+        """
+        return getattr(self.backend, "replicas", [self.backend])
+
+    def prompt_prefix(self, persona=None):
+        """
+        The static start of every chat prompt for a persona (the default one if None), as text and
+        token ids, cacheable as long as the persona is unchanged. Rebuilt only when the persona's
+        rendered context changes.
+        """
+        persona = persona or self.character_persona
+        rendered = persona.render()
+        cached = self.prefixes.get(persona)
+        if cached is None or cached[0] is not rendered:
+            prefix = "Input:\n" + rendered["context"]
+            # Encoded on its own with special tokens, exactly as backends encode the prefix they cache
+            cached = self.prefixes[persona] = (rendered, prefix, list(self.tokenizer.encode(prefix)))
+        return cached[1], cached[2]
+
+    def generate_prefix(self, persona=None):
+        return self.prompt_prefix(persona)[0]
 
     def generate_instruct(self, persona: str, instruct: str):
         context = fetch_instruct_preprompt(persona)
         prompt = "Instruction: "+ context + "\nInput: "+ instruct +"\nResponse:"
         return prompt
 
+    def generate_summary_prompt(self, previous_summary, messages, persona=None):
+        """
+        Instruct prompt folding messages (oldest first) into a channel's previous rolling summary.
+        """
+        char_name = (persona or self.character_persona).char_name
+        messages = clean_messages(messages, self.discord_name, char_name)
+        prompt = (f"Instruction: Summarize this Discord conversation with {char_name} in a few sentences, "
+                  "keeping names, facts and unanswered questions.")
+        if previous_summary:
+            prompt += "\nSummary so far: " + previous_summary
+        prompt += "\nNew messages:\n" + '\n'.join(': '.join(message) for message in messages) + "\nResponse:"
+        return prompt
+
     def generate_prompt(self,
                         current_message,
                         last_message,
-                        message_history):
+                        message_history,
+                        summary=None,
+                        max_tokens=None,
+                        history_ids=None,
+                        persona=None):
 
+        persona = persona or self.character_persona
         discord_name = self.discord_name
-        char_name = self.character_persona.char_name
+        char_name = persona.char_name
         tokenizer = self.tokenizer
-        max_tokens = self.max_tokens
+        max_tokens = max_tokens or self.max_tokens
         delim = ': '
 
-        context = self.character_persona.generate_context()
-        char_greeting = self.character_persona.generate_greeting()
+        # Persona text and token counts are rendered once per persona, not per prompt
+        rendered = persona.render()
+        prefix, prefix_ids = self.prompt_prefix(persona)
+        char_greeting = rendered["greeting"]
 
-        permanent_dialogue_context = self.character_persona.permanent_dialogue_context
+        permanent_dialogue_context = persona.permanent_dialogue_context
 
         if not permanent_dialogue_context:
-            example_dialogue = self.character_persona.generate_example_dialogue()
+            example_dialogue = rendered["example_dialogue"]
         else:
             example_dialogue = None
 
-        context_token_length = len(tokenizer.encode(context))
+        current_time = f'The date and time are {datetime.utcnow().strftime("%m/%d/%Y, %H:%M")} UTC'
+
+        instruct = f"Instruction: We are in a Discord server. As {char_name}, respond to the ongoing conversation without repeating previous dialogue.\nResponse:"
+
+        # Segments in every prompt besides the prefix; the timestamp follows the cacheable prefix so it does not invalidate it
+        time_segment = "\n" + current_time
+        closing_segments = ["\n" + instruct, "\n" + f"{char_name}:"]
+        fixed_segments = [time_segment] + closing_segments
+        # A rolling summary stands in for the older messages left out of message_history
+        summary_segments = ["\nEarlier in this conversation: " + summary] if summary else []
 
-        max_history_tokens = max_tokens - context_token_length
+        max_history_tokens = max_tokens - len(prefix_ids)
 
         reversed_context_memory, remaining_tokens = generate_history(tokenizer, 
                                                                     discord_name, char_name,
@@ -74,45 +220,74 @@ class ChatBotModel:
                                                                     last_message,
                                                                     message_history,
                                                                     max_history_tokens,
-                                                                    delim=delim)
+                                                                    delim=delim,
+                                                                    reserved_segments=fixed_segments + summary_segments,
+                                                                    history_ids=history_ids)
 
-        self.character_persona.add_memories(reversed_context_memory, location="Discord")
+        persona.add_memories(reversed_context_memory, location="Discord")
         print(f"\n|| {len(reversed_context_memory)} messages of past history utilized ||\n")
 
+        # Older memories similar to the message being answered, beyond the history window
+        recalled_memories = []
+        if persona.recall_memories and reversed_context_memory:
+            recall_start = time.time()
+            recalled_memories = persona.recall("Discord", reversed_context_memory[0][1], persona.recall_memories,
+                                               exclude=reversed_context_memory)
+            print(f"\n|| Recalled {len(recalled_memories)} memories in {(time.time() - recall_start) * 1e3:.1f}ms ||\n")
+
         temporary_context = generate_temporary_context(tokenizer, 
                                                        reversed_context_memory,
                                                        char_greeting, example_dialogue,
-                                                       remaining_tokens, delim)
+                                                       remaining_tokens, delim,
+                                                       greeting_tokens=rendered.get("greeting_tokens"),
+                                                       example_tokens=rendered.get("example_dialogue_tokens"),
+                                                       recalled_memories=recalled_memories)
 
-        current_time = f'The date and time are {datetime.utcnow().strftime("%m/%d/%Y, %H:%M")} UTC'
+        # Every segment was encoded while budgeting, so these are all token cache hits
+        context_segments = ["\n" + line for line in temporary_context]
+        history_start = len(context_segments) - len(reversed_context_memory)
+        segments = [time_segment] + context_segments[:history_start] + summary_segments + context_segments[history_start:] + closing_segments
+        prompt = TokenPrompt()
+        prompt.append(prefix, prefix_ids)
+        for segment, ids in zip(segments, encode_segments(tokenizer, segments)):
+            prompt.append(segment, ids)
 
-        instruct = f"Instruction: We are in a Discord server. As {char_name}, respond to the ongoing conversation without repeating previous dialogue.\nResponse:"
-
-        prompt = "Input:\n" + current_time + "\n" + context + "\n" + temporary_context +"\n" + instruct + "\n" + f"{char_name}:"
+        # The reply is over once the model opens a turn for anyone in the prompt, the character included
+        speakers = sorted({author for author, _ in reversed_context_memory} | {author for author, _ in recalled_memories} | {char_name})
+        stop_sequences = speaker_stop_sequences(speakers, delim) + self.stop_sequences
+        prompt.set_stop_sequences(stop_sequences, encode_segments(tokenizer, stop_sequences))
+        print(f"\n|| Prompt: {len(prompt)} of {max_tokens} tokens, token cache: {token_count_cache.stats()} ||\n")
         return prompt
 
 
     def generate_reply(self, prompt):
-        start_time = time.time()
-        clear_cache()
-        input_ids = self.tokenizer.encode(str(prompt), return_tensors="pt").cuda()
-        params = self.params
-        params["inputs"] = input_ids
-
-        print(f"\n|| Consumed Tokens: {torch.numel(input_ids)} ||\n")
-
-        output_ids = self.model.generate(**params)[0][input_ids.shape[-1]:].cuda()
-        tokens_generated = torch.numel(output_ids)
-        end_time = time.time()
-        total_time = end_time - start_time
-        print(f"\n||Generation speed: {total_time:.1f}s, {tokens_generated} tokens, {tokens_generated/total_time:.2f} tokens/s ||\n")
-        
-        response = self.tokenizer.decode(output_ids, skip_special_tokens=True)
-        
-        response = response.strip()
+        responses, _ = self.generate_replies([prompt])
+        return responses[0]
+
+
+    def generate_replies(self, prompts, text_callback=None, remember=True, replica=0, params=None, cancel_events=None,
+                         persona=None):
+        """
+        Generate replies for a batch of prompts on the backend and remember them.
+        Returns the responses in prompt order and the number of tokens generated.
+        If text_callback is given (single prompt only), decoded text is streamed to it as it is generated.
+        Pass remember=False for replies that are not sent yet, like response cache refills.
+        params overrides the generation params, e.g. for summaries.
+        cancel_events (one threading.Event per prompt) stop their prompt's generation early once set.
+        persona is the one the prompts were built for (the default one if None), whose prefix the backend caches.
+        """
+        responses, stats = self.replicas[replica].generate(prompts, params or self.params, self.generate_prefix(persona),
+                                                           text_callback, cancel_events)
+        record_generation(stats, len(prompts))
+        tokens_generated = stats["tokens_generated"]
+
+        if remember:
+            self.remember_replies(responses, persona)
+        return responses, tokens_generated
 
-        char_name = self.character_persona.char_name
-        response_memory = [(char_name, response)]
-        self.character_persona.add_memories(response_memory, location="Discord")
-        self.character_persona.save_logs(self.log_path)
-        return response
+    def remember_replies(self, responses, persona=None):
+        persona = persona or self.character_persona
+        char_name = persona.char_name
+        for response in responses:
+            response_memory = [(char_name, response)]
+            persona.add_memories(response_memory, location="Discord")
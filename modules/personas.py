@@ -0,0 +1,160 @@
+import json, os
+from collections import OrderedDict
+from modules.utils import load_json
+
+class PersonaRegistry(object):
+    """
+    Which character each guild and channel talks as, and the CharacterPersona serving each binding.
+    A channel binding wins over its guild's, which wins over the default persona the bot started with.
+    Every binding gets its own persona object, so its chat history, log and memory index stay separate,
+    while all of them share the one loaded model. At most max_loaded bound personas are kept in
+    memory; the least recently used one is flushed and closed, and reloads from its log when needed.
+    Queued and generating requests pin their persona, so one unloaded while pinned stays open until
+    its last pin is released and its replies are still logged. Bindings are saved to path so they
+    survive restarts.
+    """
+    def __init__(self, default, factory, path=None, max_loaded=32):
+        self.default = default
+        # (character, log tag) -> CharacterPersona
+        self.factory = factory
+        self.path = path
+        self.max_loaded = max_loaded
+        # "guild:<id>" or "channel:<id>" -> character
+        self.bindings = {}
+        self.loaded = OrderedDict()
+        # Pin count per persona with queued or generating requests
+        self.pins = {}
+        # (key, character, persona) unloaded while pinned, closed once unpinned
+        self.retired = []
+        # Guild of every channel seen, so background work that only knows the channel can find its persona
+        self.channel_guilds = {}
+        self.tokenizer = None
+
+        if path and os.path.exists(path):
+            self.bindings = load_json(path)
+            print(f"\n|| Loaded {len(self.bindings)} persona bindings from {path} ||\n")
+
+    def set_tokenizer(self, tokenizer):
+        """
+        Use tokenizer for the token counts of every loaded persona and the ones loaded later.
+        """
+        self.tokenizer = tokenizer
+        for persona in self.loaded.values():
+            persona.set_tokenizer(tokenizer)
+
+    def binding(self, guild_id=None, channel_id=None):
+        """
+        The binding key that applies to a channel, or None for the default persona.
+        """
+        if channel_id is not None:
+            if guild_id is not None:
+                self.channel_guilds[channel_id] = guild_id
+            else:
+                guild_id = self.channel_guilds.get(channel_id)
+            if f"channel:{channel_id}" in self.bindings:
+                return f"channel:{channel_id}"
+        if guild_id is not None and f"guild:{guild_id}" in self.bindings:
+            return f"guild:{guild_id}"
+        return None
+
+    def persona(self, guild_id=None, channel_id=None):
+        key = self.binding(guild_id, channel_id)
+        if key is None:
+            return self.default
+        persona = self.loaded.get(key)
+        if persona is None:
+            persona = self.load(key, self.bindings[key])
+        self.loaded.move_to_end(key)
+        return persona
+
+    def load(self, key, character):
+        retired = next((entry for entry in self.retired if entry[:2] == (key, character)), None)
+        if retired is not None:
+            # Still open for a pinned request, a second persona would log to the same file
+            self.retired.remove(retired)
+            persona = retired[2]
+            print(f"\n|| Reused persona {persona.char_name} for {key} ||\n")
+        else:
+            persona = self.factory(character, key.replace(':', ''))
+            if self.tokenizer is not None:
+                persona.set_tokenizer(self.tokenizer)
+            print(f"\n|| Loaded persona {persona.char_name} for {key} ||\n")
+        self.loaded[key] = persona
+        while len(self.loaded) > self.max_loaded:
+            self.unload(next(iter(self.loaded)))
+        return persona
+
+    def pin(self, persona):
+        """
+        Keep persona open until a matching unpin, for a request that will remember its reply.
+        """
+        if persona is not None and persona is not self.default:
+            self.pins[persona] = self.pins.get(persona, 0) + 1
+
+    def unpin(self, persona):
+        if persona is None or persona is self.default:
+            return
+        self.pins[persona] -= 1
+        if self.pins[persona]:
+            return
+        del self.pins[persona]
+        for entry in self.retired:
+            if entry[2] is persona:
+                self.retired.remove(entry)
+                persona.close()
+                print(f"\n|| Closed persona {persona.char_name} for {entry[0]} after its last request ||\n")
+                break
+
+    def bind(self, scope, id, character):
+        """
+        Make the guild or channel (scope) talk as character. Raises if the character cannot be loaded,
+        leaving the previous binding in place.
+        """
+        key = f"{scope}:{id}"
+        # Unload the old persona first so its log is not open twice when the character stays the same
+        self.unload(key)
+        persona = self.load(key, character)
+        self.bindings[key] = character
+        self.save()
+        return persona
+
+    def unbind(self, scope, id):
+        key = f"{scope}:{id}"
+        if key not in self.bindings:
+            return False
+        self.unload(key)
+        del self.bindings[key]
+        self.save()
+        return True
+
+    def unload(self, key):
+        persona = self.loaded.pop(key, None)
+        if persona is None:
+            return
+        if persona in self.pins:
+            # Closed by unpin once its queued and generating requests are done
+            self.retired.append((key, self.bindings.get(key), persona))
+            print(f"\n|| Unloaded persona {persona.char_name} for {key}, closing after its last request ||\n")
+        else:
+            persona.close()
+            print(f"\n|| Unloaded persona {persona.char_name} for {key} ||\n")
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.bindings, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        for persona in list(self.loaded.values()) + [persona for _, _, persona in self.retired]:
+            persona.close()
+        self.loaded.clear()
+        self.retired.clear()
+        self.pins.clear()
+
+    def report(self):
+        guilds = sum(1 for key in self.bindings if key.startswith("guild:"))
+        return (f"default {self.default.char_name}, {guilds} guild and {len(self.bindings) - guilds} channel bindings, "
+                f"{len(self.loaded)}/{self.max_loaded} bound personas loaded, {len(self.retired)} closing")
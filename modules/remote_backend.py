@@ -0,0 +1,176 @@
+import socket, json, threading, itertools, time
+from modules.text_utils import TokenPrompt
+
+def parse_address(address):
+    """
+    'unix:/path/to/socket' for a Unix socket, otherwise 'host:port' over TCP.
+    """
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+class PendingRequest(object):
+    def __init__(self, text_callback=None):
+        self.text_callback = text_callback
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class RemoteBackend(object):
+    """
+    Client for a long-lived inference worker (modules/inference_worker.py).
+
+    A single persistent connection is shared by every caller and re-opened on failure.
+    Requests are tagged with ids and written without waiting for earlier replies, so
+    several can be in flight at once; a reader thread routes replies and streamed text
+    back to the caller. A health thread pings the worker in the background.
+    """
+    def __init__(self, address, timeout=600.0, health_interval=30.0):
+        self.address = address
+        self.timeout = timeout
+        self.health_interval = health_interval
+        self.model_name = None
+
+        self.sock = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count()
+        self.healthy = False
+        self.closed = False
+
+        self.health_thread = threading.Thread(target=self.health_loop, name="worker-health", daemon=True)
+        self.health_thread.start()
+
+    def connect(self):
+        family, address = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(address)
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        threading.Thread(target=self.read_loop, args=(sock,), name="worker-reader", daemon=True).start()
+        print(f"\n|| Connected to inference worker at {self.address} ||\n")
+
+    def disconnect(self, sock, error):
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+                self.healthy = False
+            pending, self.pending = self.pending, {}
+        try:
+            sock.close()
+        except OSError:
+            pass
+        for request in pending.values():
+            request.error = error
+            request.done.set()
+
+    def read_loop(self, sock):
+        try:
+            with sock.makefile('r', encoding='utf-8') as f:
+                for line in f:
+                    message = json.loads(line)
+                    request = self.pending.get(message.get("id"))
+                    if request is None:
+                        continue
+                    if "text" in message:
+                        if request.text_callback:
+                            request.text_callback(message["text"], False)
+                        continue
+                    self.pending.pop(message["id"], None)
+                    request.error = message.get("error")
+                    request.response = message
+                    request.done.set()
+        except (OSError, ValueError) as e:
+            self.disconnect(sock, f"connection lost: {e!r}")
+            return
+        self.disconnect(sock, "connection closed by worker")
+
+    def send(self, message, text_callback=None):
+        request = PendingRequest(text_callback)
+        with self.lock:
+            if self.sock is None:
+                try:
+                    self.connect()
+                except OSError as e:
+                    raise ConnectionError(f"Inference worker at {self.address} unavailable: {e!r}")
+            message_id = next(self.ids)
+            message["id"] = message_id
+            line = (json.dumps(message) + '\n').encode('utf-8')
+            self.pending[message_id] = request
+            sock = self.sock
+            try:
+                sock.sendall(line)
+            except OSError as e:
+                self.pending.pop(message_id, None)
+                error = e
+            else:
+                error = None
+        if error:
+            self.disconnect(sock, f"send failed: {error!r}")
+            raise ConnectionError(f"Inference worker at {self.address} unavailable: {error!r}")
+        return request
+
+    def request(self, message, text_callback=None, timeout=None, cancel_events=None):
+        request = self.send(message, text_callback)
+        deadline = time.time() + (timeout or self.timeout)
+        forwarded = set()
+        # With cancel events, poll them while waiting and forward newly set ones to the worker
+        while not request.done.wait(min(0.1, deadline - time.time()) if cancel_events else deadline - time.time()):
+            if time.time() >= deadline:
+                raise TimeoutError(f"Inference worker at {self.address} did not answer {message['method']}")
+            for index, event in enumerate(cancel_events or ()):
+                if index not in forwarded and event.is_set():
+                    forwarded.add(index)
+                    try:
+                        self.send({"method": "cancel", "target": message["id"], "index": index})
+                    except ConnectionError:
+                        pass
+        if request.error:
+            raise RuntimeError(f"Inference worker error: {request.error}")
+        return request.response
+
+    def health(self):
+        try:
+            status = self.request({"method": "health"}, timeout=5.0)
+        except (OSError, TimeoutError, RuntimeError) as e:
+            self.healthy = False
+            return {"status": "unavailable", "error": str(e)}
+        self.healthy = True
+        self.model_name = status.get("model")
+        return status
+
+    def health_loop(self):
+        while not self.closed:
+            time.sleep(self.health_interval)
+            was_healthy = self.healthy
+            status = self.health()
+            if self.healthy != was_healthy:
+                print(f"\n|| Inference worker at {self.address}: {status} ||\n")
+
+    def invalidate_prefix_cache(self):
+        # Fire and forget, this is called from the event loop
+        try:
+            self.send({"method": "invalidate"})
+        except ConnectionError:
+            pass
+
+    def generate(self, prompts, params, prefix=None, text_callback=None, cancel_events=None):
+        response = self.request({"method": "generate",
+                                 # Token prompts travel as their ids so the worker does not re-tokenize them
+                                 "prompts": [prompt.to_json() if isinstance(prompt, TokenPrompt) else prompt for prompt in prompts],
+                                 "params": params,
+                                 "prefix": prefix,
+                                 "stream": bool(text_callback)},
+                                text_callback, cancel_events=cancel_events)
+        return response["responses"], response["stats"]
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            sock = self.sock
+        if sock:
+            self.disconnect(sock, "client closed")
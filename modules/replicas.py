@@ -0,0 +1,147 @@
+import os, sys, time, subprocess
+from collections import OrderedDict
+from modules.remote_backend import RemoteBackend
+
+class ReplicaPool(object):
+    """
+    Backend made of several inference workers, each with its own copy of the model.
+    The bot dispatches to individual replicas through Router; the backend methods here
+    apply to every replica.
+    """
+    def __init__(self, addresses, processes=None):
+        self.replicas = [RemoteBackend(address) for address in addresses]
+        self.processes = processes or []
+        self.model_name = None
+
+    def invalidate_prefix_cache(self):
+        for replica in self.replicas:
+            replica.invalidate_prefix_cache()
+
+    def health(self):
+        statuses = [replica.health() for replica in self.replicas]
+        self.model_name = next((replica.model_name for replica in self.replicas if replica.model_name), None)
+        healthy = sum(replica.healthy for replica in self.replicas)
+        return {"status": "ok" if healthy else "unavailable",
+                "model": self.model_name,
+                "healthy": f"{healthy}/{len(self.replicas)}",
+                "replicas": statuses}
+
+    def wait_ready(self, timeout=600.0):
+        """
+        Block until every replica answers a health check, e.g. while spawned workers load weights.
+        """
+        deadline = time.time() + timeout
+        for replica in self.replicas:
+            while replica.health()["status"] != "ok":
+                if time.time() > deadline:
+                    raise TimeoutError(f"Inference worker at {replica.address} not ready after {timeout:.0f}s")
+                time.sleep(0.5)
+
+    def generate(self, prompts, params, prefix=None, text_callback=None, cancel_events=None):
+        # Unrouted callers get the least busy healthy replica
+        replica = min(self.replicas, key=lambda replica: (not replica.healthy, len(replica.pending)))
+        return replica.generate(prompts, params, prefix, text_callback, cancel_events)
+
+    def close(self):
+        for replica in self.replicas:
+            replica.close()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+
+
+def spawn_workers(count, model_name=None, socket_dir='/tmp', token_latency=0.0, draft_model=None):
+    """
+    Start count inference worker processes on Unix sockets, one device slot each: one GPU per
+    worker round robin when CUDA is available, otherwise CPU. Without a model_name the workers
+    serve fake replies, which is enough to exercise routing on a CPU-only box.
+    Returns the worker processes and their addresses.
+    """
+    devices = ["cpu"]
+    if model_name:
+        import torch
+        if torch.cuda.is_available():
+            devices = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+
+    processes, addresses = [], []
+    for i in range(count):
+        address = f"unix:{os.path.join(socket_dir, f'llm_worker_{i}.sock')}"
+        command = [sys.executable, "-m", "modules.inference_worker", "-a", address]
+        if model_name:
+            command += ["-m", model_name, "-d", devices[i % len(devices)]]
+            if draft_model:
+                command += ["-dm", draft_model]
+        else:
+            command += ["--fake", "--token_latency", str(token_latency)]
+        processes.append(subprocess.Popen(command))
+        addresses.append(address)
+    print(f"\n|| Spawned {count} inference workers: {', '.join(addresses)} ||\n")
+    return processes, addresses
+
+
+class Router(object):
+    """
+    Picks a replica for each request. A channel sticks to the replica that served it so that
+    replica's prefix cache stays warm, unless that replica is unhealthy or has more than
+    max_imbalance requests beyond the least loaded one; new channels go to the least loaded.
+    """
+    def __init__(self, count, max_imbalance=4, max_channels=1024):
+        # Replica backends, set once the model has loaded; until then every replica counts as healthy
+        self.replicas = None
+        self.count = count
+        self.max_imbalance = max_imbalance
+        self.max_channels = max_channels
+        self.affinity = OrderedDict()
+        self.load = [0] * count
+        self.served = [0] * count
+        self.moved = 0
+
+    def healthy(self, index):
+        if self.replicas is None:
+            return True
+        return getattr(self.replicas[index], "healthy", True)
+
+    def least_loaded(self):
+        candidates = [index for index in range(self.count) if self.healthy(index)] or list(range(self.count))
+        return min(candidates, key=lambda index: self.load[index])
+
+    def route(self, channel_id):
+        """
+        Assign a request from channel_id to a replica and count it against that replica's load.
+        """
+        least = self.least_loaded()
+        index = self.affinity.get(channel_id)
+        if index is None or not self.healthy(index) or self.load[index] - self.load[least] > self.max_imbalance:
+            if index is not None:
+                self.moved += 1
+            index = least
+
+        self.affinity[channel_id] = index
+        self.affinity.move_to_end(channel_id)
+        if len(self.affinity) > self.max_channels:
+            self.affinity.popitem(last=False)
+        self.load[index] += 1
+        return index
+
+    def done(self, index, count=1):
+        self.load[index] -= count
+        self.served[index] += count
+
+    def release(self, index, count=1):
+        """
+        Undo route() for requests that were dropped before generation.
+        """
+        self.load[index] -= count
+
+    def report(self):
+        lines = []
+        for index in range(self.count):
+            channels = sum(1 for assigned in self.affinity.values() if assigned == index)
+            replica = self.replicas[index] if self.replicas else None
+            address = getattr(replica, "address", getattr(replica, "model_name", "loading"))
+            status = "healthy" if self.healthy(index) else "unhealthy"
+            lines.append(f"replica {index} ({address}): {status}, {self.load[index]} queued or running, "
+                         f"{self.served[index]} served, {channels} channels")
+        lines.append(f"{self.moved} channel moves")
+        return '\n'.join(lines)
@@ -0,0 +1,132 @@
+import json, time
+from collections import OrderedDict, deque
+
+class CacheEntry(object):
+    """
+    Cached replies for one (model, params, prompt) key.
+    """
+    def __init__(self, prompt, deterministic):
+        self.prompt = prompt
+        self.deterministic = deterministic
+        self.replies = deque()
+        self.lookups = 0
+        # Refill generations started but not yet put, so idle replicas do not duplicate them
+        self.refilling = 0
+
+
+class ResponseCache(object):
+    """
+    Replies to instruct prompts keyed on (model, generation params, prompt).
+    Deterministic params reuse one stored reply. Sampled params keep a pool of pre-generated
+    replies that are each handed out once and refilled while the generation thread is idle.
+    Replies expire after ttl seconds and the least recently used keys are evicted past max_entries.
+    """
+    def __init__(self, ttl=3600, pool_size=4, max_entries=256, refill_after=2):
+        self.ttl = ttl
+        self.pool_size = pool_size
+        self.max_entries = max_entries
+        # Only pool prompts that have been asked for more than once, not every one-off /rhyme word
+        self.refill_after = refill_after
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return bool(self.ttl)
+
+    def make_key(self, prompt, params, model_id):
+        return (str(model_id), json.dumps(params, sort_keys=True, default=str), prompt)
+
+    def expire(self, entry, now=None):
+        now = now or time.time()
+        while entry.replies and now - entry.replies[0][0] > self.ttl:
+            entry.replies.popleft()
+
+    def get(self, key, prompt, deterministic):
+        """
+        Return a cached reply for key, or None on a miss. Sampled replies are removed once returned.
+        """
+        if not self.enabled:
+            return None
+
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = CacheEntry(prompt, deterministic)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        self.entries.move_to_end(key)
+        entry.lookups += 1
+        self.expire(entry)
+
+        if not entry.replies:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if entry.deterministic:
+            return entry.replies[0][1]
+        return entry.replies.popleft()[1]
+
+    def put(self, key, reply):
+        """
+        Store a generated reply: replaces a deterministic reply, or joins a sampled pool if it has room.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        if entry.deterministic:
+            entry.replies = deque([(time.time(), reply)])
+            return
+        entry.refilling = max(entry.refilling - 1, 0)
+        if len(entry.replies) < self.pool_size:
+            entry.replies.append((time.time(), reply))
+
+    def served(self, key, reply):
+        """
+        Record a reply that was generated for and sent to a user. Only deterministic replies
+        can be reused; a sampled reply is never handed out twice.
+        """
+        entry = self.entries.get(key)
+        if entry is not None and entry.deterministic:
+            self.put(key, reply)
+
+    def refill_batch(self, max_items):
+        """
+        Up to max_items (key, prompt) pairs for sampled pools that are below pool_size,
+        most recently used first. Each pair must be followed by put() or forget().
+        """
+        if not self.enabled:
+            return []
+        batch = []
+        now = time.time()
+        for key in reversed(self.entries):
+            entry = self.entries[key]
+            if entry.deterministic or entry.lookups < self.refill_after:
+                continue
+            self.expire(entry, now)
+            missing = max(min(self.pool_size - len(entry.replies) - entry.refilling, max_items - len(batch)), 0)
+            entry.refilling += missing
+            batch.extend([(key, entry.prompt)] * missing)
+            if len(batch) >= max_items:
+                break
+        return batch
+
+    def forget(self, keys):
+        """
+        Stop refilling keys until they are asked for again, e.g. after a failed refill.
+        """
+        for key in keys:
+            if key in self.entries:
+                self.entries[key].lookups = 0
+                self.entries[key].refilling = 0
+
+    def clear(self):
+        flushed = sum(len(entry.replies) for entry in self.entries.values())
+        self.entries.clear()
+        return flushed
+
+    def stats(self):
+        pooled = sum(len(entry.replies) for entry in self.entries.values())
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return f"{len(self.entries)} prompts, {pooled} replies cached, {self.hits} hits / {self.misses} misses ({hit_rate:.0%})"
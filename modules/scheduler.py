@@ -0,0 +1,205 @@
+import asyncio, threading, time
+from typing import List
+from collections import defaultdict, deque, OrderedDict
+
+class GenerationRequest(object):
+    """
+    A single queued generation: the discord object to answer, its prompt and
+    the optional instruction shown in the reply embed.
+    """
+    def __init__(self, discord_obj, prompt, instruct=None, build_start=None):
+        self.discord_obj = discord_obj
+        self.prompt = prompt
+        self.instruct = instruct
+        self.enqueue_time = time.time()
+
+        # Per stage timings: prompt build, generation start/end and reply sent
+        self.build_time = self.enqueue_time - build_start if build_start else 0.0
+        self.start_time = None
+        self.end_time = None
+        self.sent_time = None
+
+        # Set for instruct commands whose reply can go to the response cache
+        self.cache_key = None
+        # Replica the router assigned, and why the request was dropped before generation if it was
+        self.replica = 0
+        self.dropped = None
+        # CharacterPersona the channel is bound to, None for the default persona
+        self.persona = None
+        # Reply length the budget controller allowed, None for the configured max_new_tokens
+        self.max_new_tokens = None
+
+        # Nobody will see the reply after the deadline or once cancelled; the event stops generation early
+        self.deadline = None
+        self.cancelled = None
+        self.cancel_event = threading.Event()
+
+    def cancel(self, reason):
+        if self.cancelled is None:
+            self.cancelled = reason
+            self.cancel_event.set()
+
+    def stale(self, now=None):
+        """
+        Why the reply is no longer wanted, or None. Marks expired requests cancelled.
+        """
+        if self.cancelled is None and self.deadline is not None and (now or time.time()) > self.deadline:
+            self.cancel("expired")
+        return self.cancelled
+
+    @property
+    def lane(self):
+        return "chat" if self.instruct is None else "command"
+
+    @property
+    def channel_id(self):
+        return self.discord_obj.channel.id
+
+    @property
+    def user_id(self):
+        # Messages have an author, interactions a user
+        user = getattr(self.discord_obj, 'author', None) or self.discord_obj.user
+        return user.id
+
+
+class FairQueue(object):
+    """
+    Bounded work queue with separate chat and command lanes. Lanes take turns, and within a lane
+    channels take turns and then users within a channel, so one busy channel or one user
+    spamming mentions only gets their share. A new chat request supersedes the chat requests
+    still queued for its channel, since its prompt already includes those messages.
+    Drop-in for the asyncio.Queue methods drain_queue uses.
+    """
+    lanes = ("command", "chat")
+
+    def __init__(self, max_size=32, max_per_user=3):
+        self.max_size = max_size
+        self.max_per_user = max_per_user
+        # lane -> channel id -> user id -> requests
+        self.flows = {lane: OrderedDict() for lane in self.lanes}
+        self.user_counts = defaultdict(int)
+        self.size = 0
+        self.next_lane = 0
+        self.not_empty = asyncio.Event()
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return not self.size
+
+    def put(self, request: GenerationRequest) -> bool:
+        """
+        Queue a request, or return False without queueing it if the queue or the user's share is full.
+        """
+        if self.size >= self.max_size or self.user_counts[request.user_id] >= self.max_per_user:
+            return False
+        users = self.flows[request.lane].setdefault(request.channel_id, OrderedDict())
+        users.setdefault(request.user_id, deque()).append(request)
+        self.user_counts[request.user_id] += 1
+        self.size += 1
+        self.not_empty.set()
+        return True
+
+    def supersede(self, channel_id) -> List[GenerationRequest]:
+        """
+        Remove and return every queued chat request for channel_id.
+        """
+        users = self.flows["chat"].pop(channel_id, None)
+        if not users:
+            return []
+        dropped = [request for requests in users.values() for request in requests]
+        for request in dropped:
+            self.release(request)
+        return dropped
+
+    def release(self, request: GenerationRequest):
+        self.size -= 1
+        self.user_counts[request.user_id] -= 1
+        if not self.user_counts[request.user_id]:
+            del self.user_counts[request.user_id]
+
+    def get_nowait(self) -> GenerationRequest:
+        if not self.size:
+            raise asyncio.QueueEmpty
+        for offset in range(len(self.lanes)):
+            lane_index = (self.next_lane + offset) % len(self.lanes)
+            channels = self.flows[self.lanes[lane_index]]
+            if channels:
+                break
+        self.next_lane = (lane_index + 1) % len(self.lanes)
+
+        # Serve the front user of the front channel, then rotate both to the back
+        channel_id, users = next(iter(channels.items()))
+        user_id, requests = next(iter(users.items()))
+        request = requests.popleft()
+        if requests:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        if users:
+            channels.move_to_end(channel_id)
+        else:
+            del channels[channel_id]
+        self.release(request)
+        return request
+
+    async def get(self) -> GenerationRequest:
+        while not self.size:
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        return self.get_nowait()
+
+
+async def drain_queue(queue: FairQueue, max_items: int):
+    """
+    Wait for one request, then take whatever else is already queued up to max_items.
+    """
+    batch = [await queue.get()]
+    while len(batch) < max_items:
+        try:
+            batch.append(queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return batch
+
+
+class BatchStats(object):
+    """
+    Running throughput and queue wait totals, grouped by batch size.
+    """
+    def __init__(self):
+        self.batches = defaultdict(int)
+        self.requests = defaultdict(int)
+        self.tokens = defaultdict(int)
+        self.generation_time = defaultdict(float)
+        self.queue_wait = defaultdict(float)
+
+        # Enqueue to start-of-generation wait across every request
+        self.total_requests = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    def record(self, batch, tokens_generated, generation_time, start_time):
+        batch_size = len(batch)
+        self.batches[batch_size] += 1
+        self.requests[batch_size] += batch_size
+        self.tokens[batch_size] += tokens_generated
+        self.generation_time[batch_size] += generation_time
+        waits = [start_time - request.enqueue_time for request in batch]
+        self.queue_wait[batch_size] += sum(waits)
+        self.total_requests += batch_size
+        self.total_queue_wait += sum(waits)
+        self.max_queue_wait = max(self.max_queue_wait, max(waits))
+
+    def report(self):
+        lines = []
+        for batch_size in sorted(self.batches):
+            tokens_per_second = self.tokens[batch_size] / max(self.generation_time[batch_size], 1e-9)
+            average_wait = self.queue_wait[batch_size] / self.requests[batch_size]
+            lines.append(f"batch size {batch_size}: {self.batches[batch_size]} batches, "
+                         f"{tokens_per_second:.2f} tokens/s, {average_wait:.2f}s avg queue wait")
+        if self.total_requests:
+            lines.append(f"enqueue to start: {self.total_queue_wait / self.total_requests:.3f}s avg, "
+                         f"{self.max_queue_wait:.3f}s max over {self.total_requests} requests")
+        return '\n'.join(lines)
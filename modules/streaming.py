@@ -0,0 +1,46 @@
+import asyncio, time
+
+class StreamingReply(object):
+    """
+    Coalesces streamed text into rate-limited edits of a single placeholder message.
+    feed() is called on the event loop as text arrives; run() performs the edits.
+    """
+    def __init__(self, message, edit_interval=1.0, placeholder="..."):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.placeholder = placeholder
+        self.text = ""
+        self.sent_text = placeholder
+        self.updated = asyncio.Event()
+        self.first_visible_time = None
+        self.edits = 0
+
+    def feed(self, text):
+        self.text += text
+        self.updated.set()
+
+    async def flush(self, text):
+        text = text.strip()
+        if not text or text == self.sent_text:
+            return
+        await self.message.edit(content=text)
+        self.sent_text = text
+        self.edits += 1
+        if self.first_visible_time is None:
+            self.first_visible_time = time.time()
+
+    async def run(self):
+        while True:
+            await self.updated.wait()
+            self.updated.clear()
+            await self.flush(self.text)
+            # Hold further edits so bursts of tokens collapse into one request
+            await asyncio.sleep(self.edit_interval)
+
+    async def finish(self, task: asyncio.Task, response: str):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        await self.flush(response)
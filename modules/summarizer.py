@@ -0,0 +1,86 @@
+import time
+from collections import OrderedDict
+
+class ChannelSummary(object):
+    """
+    Rolling summary of one channel's older messages.
+    """
+    def __init__(self):
+        self.text = None
+        # Newest message id folded into text; later messages stay verbatim in prompts
+        self.covered_id = 0
+        # Messages waiting to be folded in, oldest first, and whether a refresh is running
+        self.pending = None
+        self.refreshing = False
+        self.updated = None
+
+
+class ConversationSummaries(object):
+    """
+    Per-channel rolling summaries that stand in for a channel's older messages in chat prompts.
+    All but the newest keep_recent messages get folded into the summary, refresh_after messages
+    at a time or more, by generations that run while a replica has nothing queued.
+    """
+    def __init__(self, keep_recent=6, refresh_after=4, summary_tokens=150, max_channels=1024):
+        self.keep_recent = keep_recent
+        self.refresh_after = refresh_after
+        self.summary_tokens = summary_tokens
+        self.max_channels = max_channels
+        self.channels = OrderedDict()
+        self.refreshes = 0
+        self.failures = 0
+
+    def apply(self, channel_id, message_history):
+        """
+        Take a channel's newest first (id, message) history and return the summary text (or None)
+        and the messages it does not cover. Queues a refresh once enough uncovered messages
+        have scrolled past keep_recent.
+        """
+        summary = self.channels.get(channel_id)
+        if summary is None:
+            summary = self.channels[channel_id] = ChannelSummary()
+            if len(self.channels) > self.max_channels:
+                self.channels.popitem(last=False)
+        self.channels.move_to_end(channel_id)
+
+        uncovered = [(message_id, message) for message_id, message in message_history if message_id > summary.covered_id]
+        older = uncovered[self.keep_recent:]
+        if len(older) >= self.refresh_after and not summary.refreshing:
+            summary.pending = older[::-1]
+        return summary.text, uncovered
+
+    def next_refresh(self):
+        """
+        (channel id, previous summary, pending messages oldest first) for the most recently
+        active channel with a refresh queued, or None. Must be followed by complete() or fail().
+        """
+        for channel_id, summary in reversed(self.channels.items()):
+            if summary.pending and not summary.refreshing:
+                summary.refreshing = True
+                return channel_id, summary.text, summary.pending
+        return None
+
+    def complete(self, channel_id, text, covered_id):
+        summary = self.channels.get(channel_id)
+        if summary is None:
+            return
+        summary.refreshing = False
+        summary.pending = None
+        summary.text = text
+        summary.covered_id = covered_id
+        summary.updated = time.time()
+        self.refreshes += 1
+
+    def fail(self, channel_id):
+        summary = self.channels.get(channel_id)
+        if summary is not None:
+            summary.refreshing = False
+            summary.pending = None
+        self.failures += 1
+
+    def forget(self, channel_id):
+        self.channels.pop(channel_id, None)
+
+    def stats(self):
+        summarized = sum(1 for summary in self.channels.values() if summary.text)
+        return f"{summarized}/{len(self.channels)} channels summarized, {self.refreshes} refreshes, {self.failures} failed"
@@ -1,37 +1,249 @@
 import re
+from collections import OrderedDict
+from functools import lru_cache
 
-def replace_name_tokens(text, char_name, user_name):
-    text = text.replace('{{user}}', user_name).replace('<USER>', user_name)
-    text = text.replace('{{char}}', char_name).replace('<BOT>', char_name)
+# Encoded in front of every segment and then dropped, see encode_continuations
+SEGMENT_ANCHOR = "\n"
+
+def encode_continuations(tokenizer, texts):
+    """
+    Token ids for each text as it reads in the middle of a prompt, without special tokens, using
+    one batched tokenizer call. Each text is encoded behind SEGMENT_ANCHOR whose tokens are then
+    dropped, so sentencepiece tokenizers do not add their start-of-text space. If the anchor merges
+    with the text (byte level BPE), the text is encoded on its own, which is exact for those.
+    """
+    if not texts:
+        return []
+    encoded = tokenizer([SEGMENT_ANCHOR] + [SEGMENT_ANCHOR + text for text in texts], add_special_tokens=False)["input_ids"]
+    anchor_ids = list(encoded[0])
+
+    segments = []
+    unanchored = []
+    for i, ids in enumerate(encoded[1:]):
+        ids = list(ids)
+        if ids[:len(anchor_ids)] == anchor_ids:
+            segments.append(ids[len(anchor_ids):])
+        else:
+            segments.append(None)
+            unanchored.append(i)
+    if unanchored:
+        encoded = tokenizer([texts[i] for i in unanchored], add_special_tokens=False)["input_ids"]
+        for i, ids in zip(unanchored, encoded):
+            segments[i] = list(ids)
+    return segments
+
+
+class TokenCountCache(object):
+    """
+    Bounded LRU cache of prompt segment token ids keyed on tokenizer identity and the exact text.
+    Misses are encoded together in one batched call. Set enabled to False to always re-tokenize (for A/B timing).
+    """
+    def __init__(self, max_size=4096, enabled=True):
+        self.max_size = max_size
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.segments = OrderedDict()
+
+    def encode_many(self, tokenizer, texts):
+        if not self.enabled:
+            return encode_continuations(tokenizer, texts)
+
+        tokenizer_id = id(tokenizer)
+        missing = list(dict.fromkeys(text for text in texts if (tokenizer_id, text) not in self.segments))
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+        for text, ids in zip(missing, encode_continuations(tokenizer, missing)):
+            self.segments[(tokenizer_id, text)] = ids
+
+        segments = []
+        for text in texts:
+            key = (tokenizer_id, text)
+            self.segments.move_to_end(key)
+            segments.append(self.segments[key])
+        while len(self.segments) > self.max_size:
+            self.segments.popitem(last=False)
+        return segments
+
+    def count(self, tokenizer, text):
+        return len(self.encode_many(tokenizer, [text])[0])
+
+    def clear(self):
+        self.segments.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return f"{self.hits} hits, {self.misses} misses, {hit_rate:.1%} hit rate, {len(self.segments)}/{self.max_size} entries"
+
+
+token_count_cache = TokenCountCache()
+
+def encode_segments(tokenizer, texts):
+    return token_count_cache.encode_many(tokenizer, texts)
+
+def count_tokens(tokenizer, text):
+    return token_count_cache.count(tokenizer, text)
+
+
+class TokenPrompt(object):
+    """
+    A prompt kept as token ids, built by appending encoded segments. The text is kept alongside
+    for logging and for backends that only take strings; str() returns it.
+    stop_sequences end the reply where one is generated, matched on stop_ids while decoding.
+    """
+    def __init__(self, texts=None, input_ids=None, stop_sequences=None, stop_ids=None):
+        self.texts = texts or []
+        self.input_ids = input_ids or []
+        self.stop_sequences = stop_sequences or []
+        self.stop_ids = stop_ids or []
+
+    def append(self, text, ids):
+        self.texts.append(text)
+        self.input_ids.extend(ids)
+
+    def __str__(self):
+        return ''.join(self.texts)
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def set_stop_sequences(self, stop_sequences, stop_ids):
+        self.stop_sequences = list(stop_sequences)
+        self.stop_ids = [list(ids) for ids in stop_ids]
+
+    def to_json(self):
+        return {"text": str(self), "input_ids": self.input_ids,
+                "stop_sequences": self.stop_sequences, "stop_ids": self.stop_ids}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls([data["text"]], list(data["input_ids"]), data.get("stop_sequences"), data.get("stop_ids"))
+
+
+def speaker_stop_sequences(names, delim=': '):
+    """
+    The line starts that open a turn for each speaker, e.g. "\nAlice:" with the default delim.
+    """
+    return ["\n" + name + delim.rstrip() for name in names]
+
+
+def trim_stop_sequences(text, stop_sequences, truncated=False):
+    """
+    Cut text at the first stop sequence in it. If generation was truncated by max_new_tokens, a
+    last line that is the start of a turn cut off there (a prefix of a line-opening stop sequence,
+    like "\nAli") is dropped too; otherwise such a line is a real last line and is kept.
+    """
+    cut = len(text)
+    for stop in stop_sequences:
+        index = text.find(stop)
+        if index != -1 and index < cut:
+            cut = index
+    if cut < len(text) or not truncated:
+        return text[:cut]
+
+    last_line = text[text.rfind("\n"):] if "\n" in text else None
+    if last_line and any(stop.startswith(last_line) for stop in stop_sequences):
+        text = text[:len(text) - len(last_line)]
     return text
 
 
-def clean_messages(messages, discord_name, char_name):
-    is_tuple = False
+def message_segment(message, delim=': '):
+    return "\n" + delim.join(message)
 
-    if type(messages) == tuple:
-        is_tuple = True
-        messages = [messages]
-    fixed_messages = []
-    for username, message in messages:
-        fixed_username, fixed_message = replace_discord_names(username, message, discord_name, char_name)
-        fixed_message = clean_emoji_numbers(fixed_message)
-        fixed_messages.append((fixed_username, fixed_message))
-
-    if is_tuple:
-        return fixed_messages[0]
-    else:
-        return fixed_messages
 
-def clean_emoji_numbers(message):
-    pattern = r'<a?(:\w+):\d+>'
-    cleaned_message = re.sub(pattern, r'\1:', message)
-    return cleaned_message
+# Discord markup left in message text: custom emoji keep their name, mentions become readable placeholders.
+# Every branch starts with "<" so the regex engine can skip ahead to candidate positions
+DISCORD_MARKUP = r"<(?:a?(?P<emoji>:\w+):\d+|@&(?P<role>\d+)|@!?(?P<user>\d+)|#(?P<channel>\d+))>"
+MARKUP_PLACEHOLDERS = {"role": "@role", "user": "@user", "channel": "#channel"}
+
+class TextNormalizer(object):
+    """
+    Rewrites Discord markup and substitutes literal strings (bot name, persona name tokens) in a
+    single scan with one precompiled pattern. Text with nothing to rewrite is returned after a few
+    substring checks without running the regex. Cleaned messages are memoized by message id, and
+    a memoized entry is only reused while the message text is unchanged, so edits are re-cleaned.
+    With markup=False only the literal strings are substituted, as for persona text.
+    """
+    def __init__(self, replacements, max_cached=8192, markup=True):
+        self.replacements = {old: new for old, new in replacements.items() if old}
+        # Longest first so a name that contains another wins. The names are not in a group,
+        # which keeps the scan about twice as fast; a match without a group is a name
+        names = '|'.join(re.escape(old) for old in sorted(self.replacements, key=len, reverse=True))
+        if markup:
+            self.pattern = re.compile(f"{DISCORD_MARKUP}|{names}" if names else DISCORD_MARKUP)
+            self.triggers = ("<",) + tuple(self.replacements)
+        else:
+            self.pattern = re.compile(names) if names else None
+            self.triggers = tuple(self.replacements)
+        self.max_cached = max_cached
+        self.cleaned = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def substitute(self, match):
+        kind = match.lastgroup
+        if kind is None:
+            return self.replacements[match.group()]
+        if kind == "emoji":
+            # The emoji name is substituted too, as if names were replaced before the markup
+            return self.normalize(match.group("emoji")) + ":"
+        return MARKUP_PLACEHOLDERS[kind]
+
+    def normalize(self, text):
+        for trigger in self.triggers:
+            if trigger in text:
+                return self.pattern.sub(self.substitute, text)
+        return text
+
+    def normalize_message(self, message, message_id=None):
+        """
+        Clean an (author, content) message, reusing the result for message_id when its text is unchanged.
+        """
+        if message_id is None:
+            return (self.normalize(message[0]), self.normalize(message[1]))
+        cached = self.cleaned.get(message_id)
+        if cached is not None and cached[0] == message:
+            self.hits += 1
+            self.cleaned.move_to_end(message_id)
+            return cached[1]
+
+        self.misses += 1
+        cleaned = (self.normalize(message[0]), self.normalize(message[1]))
+        self.cleaned[message_id] = (message, cleaned)
+        if len(self.cleaned) > self.max_cached:
+            self.cleaned.popitem(last=False)
+        return cleaned
+
 
-def replace_discord_names(username, message, discord_name, char_name):
-    fixed_message = message.replace(discord_name, char_name)
-    fixed_username = username.replace(discord_name, char_name)
-    return fixed_username, fixed_message
+@lru_cache(maxsize=16)
+def message_normalizer(discord_name, char_name):
+    return TextNormalizer({discord_name: char_name})
+
+@lru_cache(maxsize=16)
+def name_token_normalizer(char_name, user_name):
+    # Character definitions may contain Discord-like markup on purpose, only the name tokens change
+    return TextNormalizer({'{{user}}': user_name, '<USER>': user_name, '{{char}}': char_name, '<BOT>': char_name},
+                          markup=False)
+
+
+@lru_cache(maxsize=256)
+def replace_name_tokens(text, char_name, user_name):
+    return name_token_normalizer(char_name, user_name).normalize(text)
+
+
+def clean_messages(messages, discord_name, char_name, message_ids=None):
+    """
+    Replace the bot's Discord name with the character name and clean Discord markup in a message
+    or a list of messages. message_ids, parallel to the list, memoizes each message's cleaned form.
+    """
+    normalizer = message_normalizer(discord_name, char_name)
+    if type(messages) == tuple:
+        return normalizer.normalize_message(messages)
+    message_ids = message_ids or [None] * len(messages)
+    return [normalizer.normalize_message(message, message_id) for message, message_id in zip(messages, message_ids)]
 
 
 def generate_history(tokenizer, 
@@ -40,40 +252,57 @@ def generate_history(tokenizer,
                      last_message,
                      message_history,
                      max_tokens,
-                     delim = ': '):
+                     delim = ': ',
+                     reserved_segments = (),
+                     history_ids = None):
+    """
+    Pick the most recent messages that fit in max_tokens, after the current message, the message it
+    replies to and reserved_segments (prompt segments that are always included). Every message is
+    costed exactly as its prompt segment, and all uncached segments are encoded in one batch.
+    history_ids are the Discord ids of message_history, used to memoize cleaned messages.
+    Returns the chosen messages from most recent to oldest and the tokens left over.
+    """
 
     consumed_tokens = 0
 
     reversed_context_memory = []  # This is from most recent to oldest
 
-    # Pre-allocate tokens for current_message and last_message if present
     if current_message:
         current_message = clean_messages(current_message, discord_name, char_name)
-        consumed_tokens += len(tokenizer.encode(delim.join(current_message)))
-
     if last_message:
         last_message = clean_messages(last_message, discord_name, char_name)
-        consumed_tokens += len(tokenizer.encode(delim.join(last_message)))
-
     if message_history:
-        message_history = clean_messages(message_history, discord_name, char_name)
-
-        for past_message in message_history:
-            # If last_message is in history then set last_message to None 
-            if (last_message and (last_message==past_message)):
-                last_message = None
-                message_tokens = 0
-            elif past_message==current_message:
-                print("skipping current message in history")
-                continue
-            else:
-                message_tokens = len(tokenizer.encode(delim.join(past_message)))
-
-            if (consumed_tokens + message_tokens) > max_tokens:
-                break
-            else:
-                reversed_context_memory.append(past_message)
-                consumed_tokens += message_tokens + 1
+        message_history = clean_messages(message_history, discord_name, char_name, history_ids)
+    else:
+        message_history = []
+
+    messages = [message for message in [current_message, last_message] + message_history if message]
+    segments = encode_segments(tokenizer, list(reserved_segments) + [message_segment(message, delim) for message in messages])
+    consumed_tokens += sum(len(ids) for ids in segments[:len(reserved_segments)])
+    message_tokens = {message: len(ids) for message, ids in zip(messages, segments[len(reserved_segments):])}
+
+    # Pre-allocate tokens for current_message and last_message if present
+    if current_message:
+        consumed_tokens += message_tokens[current_message]
+    if last_message:
+        consumed_tokens += message_tokens[last_message]
+
+    for past_message in message_history:
+        # If last_message is in history then set last_message to None 
+        if (last_message and (last_message==past_message)):
+            last_message = None
+            past_tokens = 0
+        elif past_message==current_message:
+            print("skipping current message in history")
+            continue
+        else:
+            past_tokens = message_tokens[past_message]
+
+        if (consumed_tokens + past_tokens) > max_tokens:
+            break
+        else:
+            reversed_context_memory.append(past_message)
+            consumed_tokens += past_tokens
 
     remaining_tokens = max_tokens - consumed_tokens
     # Append last_message and current_message
@@ -88,29 +317,46 @@ def generate_history(tokenizer,
 def generate_temporary_context(tokenizer, 
                                reversed_context_memory,
                                char_greeting, example_dialogue,
-                               max_tokens, delim = ': '):
+                               max_tokens, delim = ': ',
+                               greeting_tokens=None, example_tokens=None,
+                               recalled_memories=()):
+    """
+    Add the greeting, then the example dialogue, then each recalled memory if they still fit, and
+    return the context lines oldest first. Recalled memories go between the greeting and the history.
+    greeting_tokens and example_tokens are their segment token counts.
+    """
     consumed_tokens = 0
 
-    reversed_context_messages = [delim.join(message) for message in reversed_context_memory]
+    context_messages = [delim.join(message) for message in reversed(reversed_context_memory)]
+    greeting_lines = []
+    example_lines = []
+    recalled_lines = []
 
     if char_greeting:
-        char_message_tokens = len(tokenizer.encode(char_greeting))
+        char_message_tokens = greeting_tokens if greeting_tokens is not None else count_tokens(tokenizer, "\n" + char_greeting)
         if (consumed_tokens + char_message_tokens) > max_tokens:
             pass
         else:
-            consumed_tokens += char_message_tokens + 1
-            reversed_context_messages.append(char_greeting)
+            consumed_tokens += char_message_tokens
+            greeting_lines.append(char_greeting)
 
     if example_dialogue:
-        example_tokens = len(tokenizer.encode(example_dialogue))
+        if example_tokens is None:
+            example_tokens = count_tokens(tokenizer, "\n" + example_dialogue)
         if (consumed_tokens + example_tokens) > max_tokens:
             pass
         else:
-            consumed_tokens += example_tokens + 1
-            reversed_context_messages.append(example_dialogue)
+            consumed_tokens += example_tokens
+            example_lines.append(example_dialogue)
+
+    if recalled_memories:
+        segments = encode_segments(tokenizer, [message_segment(message, delim) for message in recalled_memories])
+        for message, ids in zip(recalled_memories, segments):
+            if (consumed_tokens + len(ids)) <= max_tokens:
+                consumed_tokens += len(ids)
+                recalled_lines.append(delim.join(message))
 
-    temporary_context = '\n'.join(reversed(reversed_context_messages))
-    return temporary_context
+    return example_lines + greeting_lines + recalled_lines + context_messages
 
 def fetch_instruct_preprompt(persona: str):
     if persona == "casual":
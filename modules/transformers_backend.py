@@ -0,0 +1,352 @@
+"""
+In-process huggingface backend. Importing this module pulls in torch and transformers, so
+modules.models only imports it once a local model is actually being loaded.
+"""
+from transformers import AutoModelForCausalLM, LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList, TextStreamer
+import torch, os, time, copy
+from collections import OrderedDict
+from modules.utils import clear_cache
+from modules.text_utils import trim_stop_sequences
+
+class PrefillTimer(LogitsProcessor):
+    """
+    Records when the first logits are produced, i.e. when prefill is done.
+    """
+    def __init__(self):
+        self.first_token_time = None
+
+    def __call__(self, input_ids, scores):
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+        return scores
+
+
+class CancelCriteria(StoppingCriteria):
+    """
+    Stops each sequence of a batch once its cancel event is set.
+    """
+    def __init__(self, events):
+        self.events = events
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.tensor([event.is_set() for event in self.events], dtype=torch.bool, device=input_ids.device)
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """
+    Stops each sequence of a batch once its generated ids end with the ids of one of its stop
+    sequences. Only positions added since the last call are checked, looked up by their last
+    token, so a step costs O(new tokens) and assisted generation cannot step over a match.
+    """
+    def __init__(self, stop_ids, prompt_length):
+        # Per sequence: last token id -> stop id tuples ending in it
+        self.stops = []
+        for sequence_stop_ids in stop_ids:
+            by_last_token = {}
+            for ids in sequence_stop_ids:
+                if ids:
+                    by_last_token.setdefault(ids[-1], []).append(tuple(ids))
+            self.stops.append(by_last_token)
+        self.longest = max((len(ids) for ids in sum(stop_ids, [])), default=0)
+        self.prompt_length = prompt_length
+        self.checked = prompt_length
+        self.stopped = [False] * len(stop_ids)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        length = input_ids.shape[-1]
+        # Enough earlier generated tokens to complete a match ending at the first new position
+        window_start = max(self.checked - self.longest + 1, self.prompt_length)
+        window = input_ids[:, window_start:].tolist()
+        for i, row in enumerate(window):
+            if self.stopped[i] or not self.stops[i]:
+                continue
+            for end in range(self.checked - window_start, length - window_start):
+                for ids in self.stops[i].get(row[end], ()):
+                    if end + 1 >= len(ids) and tuple(row[end + 1 - len(ids):end + 1]) == ids:
+                        self.stopped[i] = True
+                        break
+                if self.stopped[i]:
+                    break
+        self.checked = length
+        return torch.tensor(self.stopped, dtype=torch.bool, device=input_ids.device)
+
+
+class CallbackStreamer(TextStreamer):
+    """
+    Hands each finalized chunk of decoded text to a callback instead of printing it.
+    """
+    def __init__(self, tokenizer, callback, **decode_kwargs):
+        super().__init__(tokenizer, skip_prompt=True, **decode_kwargs)
+        self.callback = callback
+
+    def on_finalized_text(self, text, stream_end=False):
+        self.callback(text, stream_end)
+
+
+class ForwardCounter(object):
+    """
+    Counts forward passes of a model through a forward hook.
+    """
+    def __init__(self, model):
+        self.calls = 0
+        model.register_forward_hook(self.hook)
+
+    def hook(self, module, inputs, output):
+        self.calls += 1
+
+
+class DraftPolicy(object):
+    """
+    Decides whether generations use the draft model, from a moving average of how many of its
+    proposed tokens the main model accepts. Below min_acceptance it falls back to plain decoding,
+    and tries the draft again after retry_after plain generations.
+    """
+    def __init__(self, min_acceptance=0.4, retry_after=50, min_samples=3, smoothing=0.2):
+        self.min_acceptance = min_acceptance
+        self.retry_after = retry_after
+        self.min_samples = min_samples
+        self.smoothing = smoothing
+        self.enabled = True
+        self.acceptance = None
+        self.samples = 0
+        self.plain_runs = 0
+        self.fallbacks = 0
+        self.proposed = 0
+        self.accepted = 0
+        # Generated tokens and decode seconds with and without the draft
+        self.tokens = {True: 0, False: 0}
+        self.seconds = {True: 0.0, False: 0.0}
+
+    def use_draft(self):
+        if not self.enabled:
+            self.plain_runs += 1
+            if self.plain_runs > self.retry_after:
+                self.enabled = True
+                self.acceptance = None
+                self.samples = 0
+        return self.enabled
+
+    def record(self, assisted, tokens, seconds, proposed=0, accepted=0):
+        self.tokens[assisted] += tokens
+        self.seconds[assisted] += seconds
+        if not assisted or not proposed:
+            return
+        self.proposed += proposed
+        self.accepted += accepted
+        rate = accepted / proposed
+        self.acceptance = rate if self.acceptance is None else (1 - self.smoothing) * self.acceptance + self.smoothing * rate
+        self.samples += 1
+        if self.samples >= self.min_samples and self.acceptance < self.min_acceptance:
+            self.enabled = False
+            self.plain_runs = 0
+            self.fallbacks += 1
+            print(f"\n|| Draft acceptance {self.acceptance:.0%} below {self.min_acceptance:.0%}, "
+                  f"plain decoding for the next {self.retry_after} generations ||\n")
+
+    def report(self):
+        speeds = ', '.join(f"{'assisted' if assisted else 'plain'} {self.tokens[assisted] / self.seconds[assisted]:.2f} tokens/s"
+                           for assisted in (True, False) if self.seconds[assisted])
+        acceptance = self.accepted / self.proposed if self.proposed else 0.0
+        return (f"{'on' if self.enabled else 'fallen back'}, {acceptance:.0%} of {self.proposed} draft tokens accepted, "
+                f"{self.fallbacks} fallbacks" + (f", {speeds}" if speeds else ""))
+
+
+class TransformersBackend(object):
+    """
+    In-process backend running a huggingface causal LM.
+    device is a device_map: "auto" spreads the model over every GPU, "cuda:1" pins it to one
+    device slot, and "cpu" loads it unquantized for CPU-only replicas.
+    draft_model_dir is an optional small model with the same tokenizer that proposes tokens for
+    this one to verify (assisted generation), used for single prompts while it pays off.
+    max_prefixes persona prefixes keep their attention state cached, for bots serving several personas.
+    """
+    def __init__(self, model_dir, tokenizer, device="auto", draft_model_dir=None, max_prefixes=4):
+        self.model_name = os.path.basename(os.path.normpath(model_dir))
+        self.tokenizer = tokenizer
+        self.tokenizer.truncation_side = 'left'
+        # Left padding keeps every prompt in a batch ending on its "{char_name}:" tag
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # Safetensors checkpoints are memory mapped and copied straight to their device instead of
+        # being unpickled into CPU memory first; fall back to .bin checkpoints when there are none
+        self.model = self.load_model(model_dir, device)
+        self.forward_counter = ForwardCounter(self.model)
+
+        self.draft_model = None
+        self.draft_policy = None
+        if draft_model_dir:
+            # Small enough to keep unquantized, on the main model's device
+            self.draft_model = self.load_model(draft_model_dir, "cpu" if device == "cpu" else str(self.model.device), quantize=False)
+            if self.draft_model.config.vocab_size != self.model.config.vocab_size:
+                print(f"\n|| Draft model {draft_model_dir} has a different vocabulary, assisted generation disabled ||\n")
+                self.draft_model = None
+            else:
+                self.draft_counter = ForwardCounter(self.draft_model)
+                self.draft_policy = DraftPolicy()
+
+        # Prefix text -> (token ids, past key values) of personas' permanent context, reused across requests
+        self.max_prefixes = max_prefixes
+        self.prefix_cache = OrderedDict()
+
+    def load_model(self, model_dir, device, quantize=True):
+        has_safetensors = any(name.endswith('.safetensors') for name in os.listdir(model_dir))
+        load_kwargs = {"use_safetensors": True} if has_safetensors else {}
+        if device == "cpu":
+            # 8-bit loading and device maps need CUDA and accelerate, plain loading lands on the CPU
+            return AutoModelForCausalLM.from_pretrained(
+                pretrained_model_name_or_path=model_dir,
+                torch_dtype=torch.float32,
+                low_cpu_mem_usage=True,
+                **load_kwargs
+            )
+        return AutoModelForCausalLM.from_pretrained(
+            pretrained_model_name_or_path=model_dir,
+            load_in_8bit=quantize,
+            torch_dtype=torch.float16,
+            device_map=device,
+            **load_kwargs
+        )
+
+    def invalidate_prefix_cache(self):
+        self.prefix_cache.clear()
+
+    def fetch_prefix_cache(self, prefix):
+        """
+        Return the prefix token ids and past key values, building them on first use of the prefix text.
+        The least recently used prefix is dropped beyond max_prefixes.
+        """
+        if prefix not in self.prefix_cache:
+            start_time = time.time()
+            prefix_ids = self.tokenizer.encode(prefix, return_tensors="pt").to(self.model.device)
+            with torch.no_grad():
+                past_key_values = self.model(prefix_ids, use_cache=True).past_key_values
+            self.prefix_cache[prefix] = (prefix_ids[0], past_key_values)
+            while len(self.prefix_cache) > self.max_prefixes:
+                self.prefix_cache.popitem(last=False)
+            print(f"\n|| Prefix cache built: {len(prefix_ids[0])} tokens in {time.time() - start_time:.2f}s, "
+                  f"{len(self.prefix_cache)}/{self.max_prefixes} prefixes cached ||\n")
+        self.prefix_cache.move_to_end(prefix)
+        return self.prefix_cache[prefix]
+
+    def encode_prompts(self, prompts):
+        """
+        Left-padded input_ids and attention_mask for a batch. Token prompts already carry their ids;
+        plain string prompts (instruct commands, warmup) are tokenized together in one call.
+        """
+        strings = [prompt for prompt in prompts if not hasattr(prompt, "input_ids")]
+        encoded = iter(self.tokenizer(strings)["input_ids"]) if strings else iter(())
+        prompt_ids = [list(prompt.input_ids) if hasattr(prompt, "input_ids") else next(encoded) for prompt in prompts]
+
+        length = max(len(ids) for ids in prompt_ids)
+        pad_token_id = self.tokenizer.pad_token_id
+        input_ids = [[pad_token_id] * (length - len(ids)) + ids for ids in prompt_ids]
+        attention_mask = [[0] * (length - len(ids)) + [1] * len(ids) for ids in prompt_ids]
+        return {"input_ids": torch.tensor(input_ids, device=self.model.device),
+                "attention_mask": torch.tensor(attention_mask, device=self.model.device)}
+
+    def health(self):
+        health = {"status": "ok", "model": self.model_name}
+        if self.draft_policy:
+            health["draft"] = self.draft_policy.report()
+        return health
+
+    def generate(self, prompts, params, prefix=None, text_callback=None, cancel_events=None):
+        """
+        Generate replies for a batch of prompts with a single model.generate call.
+        Returns the responses in prompt order and a dict of token counts and timings.
+        If text_callback is given (single prompt only), decoded text is streamed to it as it is generated.
+        cancel_events holds one threading.Event per prompt; a sequence stops early once its event is set.
+        """
+        start_time = time.time()
+        clear_cache()
+        inputs = self.encode_prompts(prompts)
+        params = dict(params)
+        params.pop("draft_model", None)
+        params.update(inputs)
+
+        print(f"\n|| Consumed Tokens: {int(inputs['attention_mask'].sum())} over {len(prompts)} prompt(s) ||\n")
+
+        # Reuse the persona prefix attention state; left padding shifts it for batches, so only single prompts
+        cached_tokens = 0
+        if prefix and len(prompts) == 1:
+            prefix_ids, prefix_past_key_values = self.fetch_prefix_cache(prefix)
+            input_ids = inputs["input_ids"][0]
+            if len(input_ids) > len(prefix_ids) and torch.equal(input_ids[:len(prefix_ids)], prefix_ids):
+                params["past_key_values"] = copy.deepcopy(prefix_past_key_values)
+                cached_tokens = len(prefix_ids)
+
+        prefill_timer = PrefillTimer()
+        params["logits_processor"] = LogitsProcessorList([prefill_timer])
+        stopping_criteria = StoppingCriteriaList()
+        if cancel_events:
+            stopping_criteria.append(CancelCriteria(cancel_events))
+        stop_ids = [getattr(prompt, "stop_ids", []) for prompt in prompts]
+        stop_criteria = StopSequenceCriteria(stop_ids, inputs["input_ids"].shape[-1]) if any(stop_ids) else None
+        if stop_criteria:
+            stopping_criteria.append(stop_criteria)
+        if stopping_criteria:
+            params["stopping_criteria"] = stopping_criteria
+        if text_callback and len(prompts) == 1:
+            params["streamer"] = CallbackStreamer(self.tokenizer, text_callback, skip_special_tokens=True)
+
+        # Assisted generation verifies one sequence at a time, and contrastive search cannot be assisted
+        contrastive = params.get("penalty_alpha") and not params.get("do_sample")
+        assisted = (self.draft_model is not None and len(prompts) == 1 and params.get("num_beams", 1) == 1
+                    and not contrastive and self.draft_policy.use_draft())
+        if assisted:
+            params["assistant_model"] = self.draft_model
+            params.pop("penalty_alpha", None)
+        forward_calls = self.forward_counter.calls
+        draft_calls = self.draft_counter.calls if self.draft_model is not None else 0
+        generate_start_time = time.time()
+
+        output_ids = self.model.generate(**params)[:, inputs["input_ids"].shape[-1]:]
+        reply_tokens = (output_ids != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+        tokens_generated = sum(reply_tokens)
+        end_time = time.time()
+        total_time = end_time - start_time
+
+        first_token_time = prefill_timer.first_token_time or end_time
+        prefill_time = first_token_time - generate_start_time
+        if cached_tokens:
+            print(f"\n|| Prefill: {prefill_time:.3f}s with {cached_tokens} cached prefix tokens ||\n")
+        else:
+            print(f"\n|| Prefill: {prefill_time:.3f}s without prefix cache ||\n")
+        print(f"\n||Generation speed: {total_time:.1f}s, {tokens_generated} tokens, {tokens_generated/total_time:.2f} tokens/s ||\n")
+
+        draft_tokens = accepted_tokens = 0
+        if assisted:
+            # Each verification pass keeps the accepted draft tokens plus one token of its own
+            draft_tokens = self.draft_counter.calls - draft_calls
+            verify_steps = self.forward_counter.calls - forward_calls
+            accepted_tokens = min(max(tokens_generated - verify_steps, 0), draft_tokens)
+            print(f"\n|| Assisted: {accepted_tokens}/{draft_tokens} draft tokens accepted over {verify_steps} verification passes ||\n")
+        if self.draft_policy:
+            self.draft_policy.record(assisted, tokens_generated, end_time - first_token_time, draft_tokens, accepted_tokens)
+
+        responses = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+        # Replies that used every new token may end in the start of a speaker turn that got cut off
+        max_new_tokens = params.get("max_new_tokens", self.model.generation_config.max_new_tokens)
+        truncated = [max_new_tokens is not None and tokens >= max_new_tokens for tokens in reply_tokens]
+        responses = [trim_stop_sequences(response, getattr(prompt, "stop_sequences", []), truncated[i]).strip()
+                     for i, (prompt, response) in enumerate(zip(prompts, responses))]
+        stopped = sum(stop_criteria.stopped) if stop_criteria else 0
+        if stop_criteria:
+            print(f"\n|| Stop sequences: {stopped}/{len(prompts)} replies ended at a speaker turn, "
+                  f"{tokens_generated / len(prompts):.1f} tokens per reply ||\n")
+        stats = {"tokens_generated": tokens_generated,
+                 "reply_tokens": reply_tokens,
+                 "stopped": stopped,
+                 "prompt_tokens": inputs["attention_mask"].sum(dim=1).tolist(),
+                 "cached_tokens": cached_tokens,
+                 "draft_tokens": draft_tokens,
+                 "accepted_tokens": accepted_tokens,
+                 "prefill_time": prefill_time,
+                 "decode_time": end_time - first_token_time,
+                 "total_time": total_time}
+        return responses, stats
+
+    def close(self):
+        pass
@@ -1,4 +1,5 @@
-import json, gc, torch, os
+import json, gc, os, time
+from contextlib import contextmanager
 
 def load_json(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -6,5 +7,41 @@ def load_json(file_path):
     return json_dict
 
 def clear_cache():
+    # Only the transformers backend calls this, torch is imported by then
+    import torch
     gc.collect()
     torch.cuda.empty_cache()
+
+
+class PhaseTimer(object):
+    """
+    Wall-clock durations of named startup phases, in the order they finished.
+    """
+    def __init__(self):
+        self.durations = {}
+        self.started = {}
+
+    def start(self, name):
+        self.started[name] = time.time()
+
+    def stop(self, name):
+        if name in self.started:
+            self.record(name, time.time() - self.started.pop(name))
+
+    def record(self, name, duration):
+        self.durations[name] = duration
+        print(f"\n|| Startup: {name} took {duration:.2f}s ||\n")
+
+    @contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def report(self):
+        return ', '.join(f"{name} {duration:.2f}s" for name, duration in self.durations.items())
+
+
+startup_timer = PhaseTimer()